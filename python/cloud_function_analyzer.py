@@ -1,50 +1,474 @@
-import os
-import json
+import copy
+import functools
+import hashlib
+import io
 import logging
-from typing import Dict, List, Any
-from google.cloud import aiplatform
-from google.cloud import pubsub_v1
-import functions_framework
-import subprocess
-import tempfile
+import os
+import random
+import re
 import shutil
+import tempfile
+import threading
+import time
+import tokenize
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple
+
+import functions_framework
+import msgpack
+import orjson
+import pygit2
+import xxhash
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# --- BEST PRACTICE: Initialize clients in the global scope ---
-# They will be reused across function invocations.
-try:
-    # --- BEST PRACTICE: Use Environment Variables for Configuration ---
-    PROJECT_ID = os.getenv("GCP_PROJECT_ID")
-    REGION = os.getenv("GCP_REGION", "us-central1")
-    ENDPOINT_ID = os.getenv("VERTEX_ENDPOINT_ID")
-    PUB_SUB_TOPIC = os.getenv("PUB_SUB_TOPIC")
+# File extensions considered source code, as a tuple for str.endswith
+CODE_EXTS = ('.py', '.js', '.ts', '.java', '.cpp', '.c', '.go', '.rs', '.php')
 
-    if not all([PROJECT_ID, ENDPOINT_ID, PUB_SUB_TOPIC]):
+# Non-code directories skipped while scanning, in addition to hidden ones
+SKIP_DIRS = frozenset({'node_modules', '__pycache__', 'venv', 'env'})
+
+# Files larger than this are skipped (generated bundles, vendored blobs)
+MAX_FILE_BYTES = 256 * 1024
+
+# Minified files and vendored or build output directories are skipped too
+SKIP_PATH_RE = re.compile(r'\.min\.|/(?:vendor|dist|build)/')
+
+# Bytes sniffed for a NUL to reject binaries with a code extension
+BINARY_SNIFF_BYTES = 512
+
+# Comments are stripped from files at least this large before prompting
+MIN_STRIP_BYTES = 2 * 1024
+
+# Line and block comments in C-family sources; string literals are matched
+# too (group 1) so comment markers inside them are left alone
+C_COMMENT_RE = re.compile(
+    r'//[^\n]*|/\*.*?\*/|("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|`(?:\\.|[^`\\])*`)',
+    re.DOTALL
+)
+TRAILING_WS_RE = re.compile(r'[ \t]+$', re.MULTILINE)
+
+# Reads release the GIL, so a wide pool overlaps filesystem latency
+MAX_READ_WORKERS = 32
+
+# Source is sharded into prompts of at most this many bytes, one prediction each
+MAX_CHUNK_BYTES = 8 * 1024
+
+# In-flight predictions allowed per Vertex AI endpoint, and retries per prediction
+MAX_CONCURRENT_PER_ENDPOINT = int(os.getenv("MAX_CONCURRENT_PER_ENDPOINT", "4"))
+PREDICT_MAX_ATTEMPTS = 5
+
+PREDICTION_PARAMETERS = {
+    "maxOutputTokens": 4096,  # Increased for comprehensive analysis
+    "temperature": 0.1,       # Very low temperature for consistent results
+    "topP": 0.8,
+    "topK": 40
+}
+
+RISK_LEVELS = ("low", "medium", "high", "critical")
+
+# Analyses of pinned commits are memoized in-process and, if set, in this bucket
+CACHE_BUCKET = os.getenv("CACHE_BUCKET")
+ANALYSIS_CACHE_SIZE = 128
+
+# Refs that name a commit directly: a full SHA-1 or SHA-256 object ID. Anything
+# else (branches, tags, abbreviated hashes) can move.
+_COMMIT_SHA_RE = re.compile(r"[0-9a-fA-F]{40}|[0-9a-fA-F]{64}")
+
+# Rule of the placeholder issue reported when the model's response is not JSON
+PARSE_FALLBACK_RULE = "AI-PARSE-001"
+
+# Bare clones of remote repositories kept in /tmp across warm invocations,
+# least recently used first
+REPO_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'repos')
+REPO_CACHE_MAX = 8
+_REPO_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_REPO_CACHE_LOCK = threading.Lock()  # Guards the two dicts only, never held across I/O
+_REPO_LOCKS: Dict[str, threading.Lock] = {}  # One per URL, held while fetching into its clone
+
+# The remote's HEAD is fetched into this ref; a bare clone's own HEAD never moves
+_REMOTE_HEAD_REF = 'refs/remotes/origin/HEAD'
+
+class EndpointPool:
+    """
+    Least-connections dispatcher over one or more Vertex AI endpoints.
+    
+    Each prediction goes to the endpoint with the fewest in-flight requests.
+    As long as callers run at most ``capacity`` predictions at once, no
+    endpoint ever has more than ``max_concurrent`` outstanding.
+    
+    Args:
+        client: Prediction service client shared by all endpoints
+        endpoints: Full resource names of the endpoints
+        max_concurrent: Maximum in-flight predictions per endpoint
+    """
+    
+    def __init__(self, client: Any, endpoints: List[str], max_concurrent: int):
+        self.client = client
+        self.endpoints = endpoints
+        self.capacity = len(endpoints) * max_concurrent
+        self._pending = [0] * len(endpoints)
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> int:
+        """Reserve the least-loaded endpoint and return its index."""
+        with self._lock:
+            index = min(range(len(self._pending)), key=self._pending.__getitem__)
+            self._pending[index] += 1
+            return index
+    
+    def release(self, index: int) -> None:
+        """Release a reservation made by acquire()."""
+        with self._lock:
+            self._pending[index] -= 1
+    
+    def predict(self, instances: List[Dict[str, Any]], parameters: Dict[str, Any]):
+        """Run a prediction, retrying failures with jittered exponential backoff."""
+        for attempt in range(PREDICT_MAX_ATTEMPTS):
+            index = self.acquire()
+            try:
+                return self.client.predict(
+                    endpoint=self.endpoints[index], instances=instances, parameters=parameters
+                )
+            except Exception as e:
+                if attempt == PREDICT_MAX_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"⚠️ Prediction attempt {attempt + 1} failed: {e}")
+            finally:
+                self.release(index)
+            time.sleep(2 ** attempt * 0.1 + random.random() * 0.1)
+
+
+# --- BEST PRACTICE: Use Environment Variables for Configuration ---
+PROJECT_ID = os.getenv("GCP_PROJECT_ID")
+REGION = os.getenv("GCP_REGION", "us-central1")
+ENDPOINT_ID = os.getenv("VERTEX_ENDPOINT_ID")
+PUB_SUB_TOPIC = os.getenv("PUB_SUB_TOPIC")
+
+# Pub/Sub payload encoding: "json" (default) or the more compact "msgpack",
+# for consumers that honour the message's content_type attribute
+PUBSUB_ENCODING = os.getenv("PUBSUB_ENCODING", "json")
+
+# Also publish each chunk's findings as soon as it is analyzed, marked with a
+# partial="true" attribute; the merged result is always published last
+PUBLISH_PARTIAL_RESULTS = os.getenv("PUBLISH_PARTIAL_RESULTS", "false").lower() == "true"
+
+
+# --- BEST PRACTICE: Initialize clients lazily and reuse them across invocations ---
+# Importing the Google Cloud SDKs dominates cold start, so each client is only
+# built by the first invocation that actually needs it.
+@functools.lru_cache(maxsize=1)
+def get_vertex_endpoint() -> EndpointPool:
+    """
+    Return the pool of Vertex AI endpoints (VERTEX_ENDPOINT_ID may list several).
+    
+    Only the thin GAPIC prediction client is imported; the high-level
+    ``aiplatform`` SDK and its ``aiplatform.init`` are not needed to predict.
+    """
+    from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceClient
+    
+    if not all([PROJECT_ID, ENDPOINT_ID]):
         raise ValueError("Missing required environment variables")
+    
+    client = PredictionServiceClient(
+        client_options={"api_endpoint": f"{REGION}-aiplatform.googleapis.com"}
+    )
+    endpoint_pool = EndpointPool(
+        client,
+        [
+            client.endpoint_path(PROJECT_ID, REGION, endpoint_id.strip())
+            for endpoint_id in ENDPOINT_ID.split(",")
+        ],
+        MAX_CONCURRENT_PER_ENDPOINT
+    )
+    logger.info("✅ Vertex AI client initialized successfully.")
+    return endpoint_pool
+
 
-    # Initialize the Vertex AI SDK
-    aiplatform.init(project=PROJECT_ID, location=REGION)
+@functools.lru_cache(maxsize=1)
+def get_publisher():
+    """Return the Pub/Sub publisher; messages are batched in the background."""
+    from google.cloud import pubsub_v1
     
-    # Get an object representing the endpoint
-    vertex_endpoint = aiplatform.Endpoint(
-        endpoint_id=ENDPOINT_ID, 
-        project=PROJECT_ID, 
-        location=REGION
+    publisher = pubsub_v1.PublisherClient(
+        batch_settings=pubsub_v1.types.BatchSettings(
+            max_messages=100,
+            max_bytes=1024 * 1024,
+            max_latency=0.05,
+        )
     )
+    logger.info("✅ Pub/Sub client initialized successfully.")
+    return publisher
+
+
+@functools.lru_cache(maxsize=1)
+def get_topic_path() -> str:
+    """Return the fully qualified path of the analysis results topic."""
+    if not all([PROJECT_ID, PUB_SUB_TOPIC]):
+        raise ValueError("Missing required environment variables")
+    return get_publisher().topic_path(PROJECT_ID, PUB_SUB_TOPIC)
+
+
+def _client_available(getter) -> bool:
+    """Initialize a client through its getter, reporting whether it succeeded."""
+    try:
+        getter()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error initializing clients: {e}")
+        return False
+
+
+def _remote_revision(commit_hash: str) -> str:
+    """Revision to resolve in a clone made by _fetch_commit for commit_hash."""
+    if not commit_hash or commit_hash == 'HEAD':
+        return _REMOTE_HEAD_REF
+    if _COMMIT_SHA_RE.fullmatch(commit_hash):
+        return commit_hash
+    return f'refs/remotes/origin/{commit_hash}'
+
+
+def _fetch_commit(repo: pygit2.Repository, commit_hash: str) -> None:
+    """
+    Fetch a single commit from origin into a bare repo with depth 1.
+
+    The remote's HEAD, or a branch, is fetched into its remote-tracking
+    ref on every call, so upstream pushes are picked up; a pinned SHA is
+    fetched directly (``want <sha>`` + ``deepen 1``) so no history beyond
+    that commit is transferred. Servers only hand out full object IDs, so
+    an abbreviated hash cannot be fetched.
+
+    Args:
+        repo: Bare repository with an 'origin' remote
+        commit_hash: Full commit SHA, branch name, or 'HEAD'
+        
+    Raises:
+        pygit2.GitError: If the fetch fails or commit_hash is an
+            abbreviated hash that is not a branch name either
+    """
+    remote = repo.remotes['origin']
+    if not commit_hash or commit_hash == 'HEAD':
+        remote.fetch([f'+HEAD:{_REMOTE_HEAD_REF}'], depth=1)
+    elif _COMMIT_SHA_RE.fullmatch(commit_hash):
+        remote.fetch([commit_hash], depth=1)
+    else:
+        remote.fetch([f'+refs/heads/{commit_hash}:{_remote_revision(commit_hash)}'], depth=1)
+        if _remote_revision(commit_hash) not in repo.references:
+            if re.fullmatch(r'[0-9a-fA-F]{4,39}', commit_hash):
+                raise pygit2.GitError(
+                    f"Abbreviated commit hash '{commit_hash}' cannot be fetched from a remote "
+                    "repository; pass the full commit hash"
+                )
+            raise pygit2.GitError(f"Unknown branch '{commit_hash}'")
+
+
+def _shallow_fetch(repo_path: str, commit_hash: str, dest: str) -> pygit2.Repository:
+    """
+    Fetch a single commit of a remote repository into a new bare repo.
+
+    Nothing is checked out - files are read from the object database.
+
+    Args:
+        repo_path: Repository URL
+        commit_hash: Full commit SHA, branch name, or 'HEAD'
+        dest: Directory to create the bare repository in
+
+    Returns:
+        The bare repository
+    """
+    repo = pygit2.init_repository(dest, bare=True)
+    repo.remotes.create('origin', repo_path)
+    _fetch_commit(repo, commit_hash)
+    return repo
+
+
+def _scan_code_paths(root: str) -> List[str]:
+    """
+    Collect code file paths under root using os.scandir.
     
-    # Initialize the Pub/Sub client
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(PROJECT_ID, PUB_SUB_TOPIC)
+    Hidden and common non-code directories are pruned without descending
+    into them, and file type and size come from the cached directory entry.
+    Minified, vendored, build-output and oversized files are left out.
+    """
+    paths = []
+    pending = [root]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.') and entry.name not in SKIP_DIRS:
+                        pending.append(entry.path)
+                elif (
+                    entry.name.endswith(CODE_EXTS)
+                    and not SKIP_PATH_RE.search(entry.path, len(root))
+                    and entry.stat(follow_symlinks=False).st_size <= MAX_FILE_BYTES
+                ):
+                    paths.append(entry.path)
+    return paths
+
 
-    logger.info("✅ Clients initialized successfully.")
+def _read_one(path: str) -> Tuple[str, Optional[bytes]]:
+    """Read a file's raw bytes, returning None for binary or unreadable files."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(BINARY_SNIFF_BYTES)
+            if b'\x00' in head:
+                return path, None
+            return path, head + f.read()
+    except OSError as e:
+        logger.warning(f"⚠️ Could not read file {path}: {e}")
+        return path, None
 
-except Exception as e:
-    logger.error(f"❌ Error initializing clients: {e}")
-    publisher = None 
-    vertex_endpoint = None
+
+def iter_code_files(root: str) -> Iterator[Tuple[str, str]]:
+    """
+    Return an iterator of (relative_path, content) for each non-empty code file under root.
+    
+    The directory is scanned by this call, so a missing or unreadable root
+    raises OSError here rather than while iterating. Files are read by a
+    thread pool ahead of the consumer, so callers can start working on
+    early files while later ones are still being read.
+    """
+    return _read_code_files(root, _scan_code_paths(root))
+
+
+def _read_code_files(root: str, paths: List[str]) -> Iterator[Tuple[str, str]]:
+    """Yield (relative_path, content) for the non-empty files among paths."""
+    with ThreadPoolExecutor(max_workers=MAX_READ_WORKERS) as executor:
+        for file_path, data in executor.map(_read_one, paths):
+            if data is None:
+                continue
+            content = data.decode('utf-8', 'ignore')
+            if content.strip():  # Only include non-empty files
+                yield os.path.relpath(file_path, root), content
+
+
+def iter_tree_files(repo: pygit2.Repository, tree: pygit2.Tree) -> Iterator[Tuple[str, str]]:
+    """
+    Yield (path, content) for each non-empty code file in a git tree.
+    
+    Blobs are read straight from the object database, so nothing is
+    written to disk. The same directories, paths, binary files and
+    oversized files are skipped as for a working tree scan.
+    """
+    pending = [('', tree)]
+    while pending:
+        prefix, current = pending.pop()
+        for entry in current:
+            if entry.type == pygit2.GIT_OBJECT_TREE:
+                if not entry.name.startswith('.') and entry.name not in SKIP_DIRS:
+                    pending.append((f"{prefix}{entry.name}/", repo[entry.id]))
+                continue
+            if entry.type != pygit2.GIT_OBJECT_BLOB or not entry.name.endswith(CODE_EXTS):
+                continue
+            file_path = prefix + entry.name
+            if SKIP_PATH_RE.search(f"/{file_path}"):
+                continue
+            blob = repo[entry.id]
+            if blob.size > MAX_FILE_BYTES or blob.is_binary:
+                continue
+            content = blob.data.decode('utf-8', 'ignore')
+            if content.strip():  # Only include non-empty files
+                yield file_path, content
+
+
+def get_repo(url: str, commit_hash: str) -> pygit2.Repository:
+    """
+    Return a bare clone of a remote repository containing the given commit.
+    
+    Clones are cached per URL under REPO_CACHE_DIR for the lifetime of the
+    instance. A cached clone that already has a pinned commit is used
+    without touching the network; otherwise only the missing commit (or the
+    latest HEAD) is fetched into it. Fetches for different URLs run in
+    parallel; only requests for the same URL wait for each other. Beyond
+    REPO_CACHE_MAX clones, the least recently used one is deleted.
+    
+    Resolve the requested commit with _remote_revision(commit_hash), not
+    the clone's own HEAD.
+    
+    Args:
+        url: Repository URL
+        commit_hash: Full commit SHA, branch name, or 'HEAD'
+        
+    Returns:
+        The cached bare repository
+    """
+    with _REPO_CACHE_LOCK:
+        url_lock = _REPO_LOCKS.setdefault(url, threading.Lock())
+    
+    with url_lock:
+        with _REPO_CACHE_LOCK:
+            path = _REPO_CACHE.get(url)
+            if path is not None:
+                _REPO_CACHE.move_to_end(url)
+        
+        if path is not None:
+            repo = pygit2.Repository(path)
+            # Only a full commit ID already in the clone can skip the network
+            if not _COMMIT_SHA_RE.fullmatch(commit_hash or '') or commit_hash not in repo:
+                _fetch_commit(repo, commit_hash)
+            return repo
+        
+        path = os.path.join(REPO_CACHE_DIR, hashlib.blake2b(url.encode(), digest_size=16).hexdigest())
+        shutil.rmtree(path, ignore_errors=True)  # Leftover from a failed fetch
+        try:
+            repo = _shallow_fetch(url, commit_hash, path)
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        
+        with _REPO_CACHE_LOCK:
+            _REPO_CACHE[url] = path
+            evicted = None
+            if len(_REPO_CACHE) > REPO_CACHE_MAX:
+                evicted_url, evicted_path = _REPO_CACHE.popitem(last=False)
+                evicted = (_REPO_LOCKS.pop(evicted_url), evicted_path)
+    
+    if evicted is not None:
+        # Wait for any fetch still writing into the evicted clone
+        evicted_lock, evicted_path = evicted
+        with evicted_lock:
+            shutil.rmtree(evicted_path, ignore_errors=True)
+    return repo
+
+
+def open_commit_files(repo_path: str, commit_hash: str) -> Iterator[Tuple[str, str]]:
+    """
+    Resolve a repository at a specific commit to a stream of its code files.
+    
+    Remote repositories are fetched into the instance's repo cache and pinned commits of
+    local repositories are read from their object database; in both cases
+    blobs are read without a checkout. A local repository at HEAD is read
+    from its working tree in place.
+    
+    Fetching and scanning happen eagerly so git and filesystem errors are
+    raised by this call rather than while iterating.
+    
+    Args:
+        repo_path: Repository URL or local path
+        commit_hash: Git commit hash to read, or 'HEAD'
+        
+    Returns:
+        Iterator of (relative_path, content) pairs
+    """
+    if repo_path.startswith(('http://', 'https://', 'git@')):
+        # Remote repository - fetch only the requested commit
+        repo = get_repo(repo_path, commit_hash)
+        revision = _remote_revision(commit_hash)
+    elif not commit_hash or commit_hash == 'HEAD':
+        # Local repository at HEAD - read the working tree directly
+        return iter_code_files(repo_path)
+    else:
+        # Local repository at a pinned commit - leave its worktree and index untouched
+        repo = pygit2.Repository(repo_path)
+        revision = commit_hash
+    
+    commit = repo.revparse_single(revision).peel(pygit2.Commit)
+    return iter_tree_files(repo, commit.tree)
 
 
 def fetch_code_from_repo(repo_path: str, commit_hash: str) -> Dict[str, str]:
@@ -52,9 +476,9 @@ def fetch_code_from_repo(repo_path: str, commit_hash: str) -> Dict[str, str]:
     Fetch code from a repository at a specific commit.
     
     This function:
-    1. Clones the repository to a temporary directory
-    2. Checks out the specific commit hash
-    3. Reads the contents of relevant code files
+    1. Fetches the specific commit into a cached bare repository (depth 1)
+    2. Resolves the commit's tree (local repositories are read in place)
+    3. Reads the contents of relevant code files from the object database
     4. Returns a dictionary mapping file paths to their contents
     
     Args:
@@ -66,80 +490,40 @@ def fetch_code_from_repo(repo_path: str, commit_hash: str) -> Dict[str, str]:
     """
     logger.info(f"📥 Fetching code for repo '{repo_path}' at commit '{commit_hash}'...")
     
-    code_files = {}
-    temp_dir = None
-    
     try:
-        # Create temporary directory
-        temp_dir = tempfile.mkdtemp()
-        
-        # Clone repository
-        if repo_path.startswith(('http://', 'https://', 'git@')):
-            # Remote repository
-            subprocess.run([
-                'git', 'clone', '--depth', '1', repo_path, temp_dir
-            ], check=True, capture_output=True, text=True)
-        else:
-            # Local repository - copy to temp directory
-            shutil.copytree(repo_path, temp_dir, dirs_exist_ok=True)
-        
-        # Change to repository directory
-        os.chdir(temp_dir)
-        
-        # Checkout specific commit if not HEAD
-        if commit_hash and commit_hash != 'HEAD':
-            subprocess.run([
-                'git', 'checkout', commit_hash
-            ], check=True, capture_output=True, text=True)
-        
-        # Find and read code files
-        code_extensions = {'.py', '.js', '.ts', '.java', '.cpp', '.c', '.go', '.rs', '.php'}
-        
-        for root, dirs, files in os.walk(temp_dir):
-            # Skip hidden directories and common non-code directories
-            dirs[:] = [d for d in dirs if not d.startswith('.') and d not in {'node_modules', '__pycache__', 'venv', 'env'}]
-            
-            for file in files:
-                if any(file.endswith(ext) for ext in code_extensions):
-                    file_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(file_path, temp_dir)
-                    
-                    try:
-                        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                            content = f.read()
-                            if content.strip():  # Only include non-empty files
-                                code_files[relative_path] = content
-                    except Exception as e:
-                        logger.warning(f"⚠️ Could not read file {relative_path}: {e}")
+        code_files = dict(open_commit_files(repo_path, commit_hash))
         
         logger.info(f"✅ Successfully fetched {len(code_files)} code files")
         return code_files
         
-    except subprocess.CalledProcessError as e:
+    except (pygit2.GitError, KeyError) as e:
         logger.error(f"❌ Git operation failed: {e}")
-        return {"error": f"Git operation failed: {e.stderr}"}
+        return {"error": f"Git operation failed: {e}"}
     except Exception as e:
         logger.error(f"❌ Failed to fetch code: {e}")
         return {"error": str(e)}
-    finally:
-        # Cleanup temporary directory
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
 
 
-def create_comprehensive_prompt(code_files: Dict[str, str]) -> str:
+def create_comprehensive_prompt(
+    code_files: Dict[str, str], duplicate_paths: Optional[Dict[str, List[str]]] = None
+) -> str:
     """
     Create a comprehensive analysis prompt for multiple files.
     
     Args:
         code_files: Dictionary mapping file paths to their contents
+        duplicate_paths: Optional mapping of a file path to other paths with
+            identical content, noted after that file instead of repeating it
         
     Returns:
         Formatted prompt string
     """
-    files_content = ""
-    for file_path, content in code_files.items():
-        files_content += f"\n--- FILE: {file_path} ---\n{content}\n"
+    duplicate_paths = duplicate_paths or {}
+    files_content = "".join(
+        f"\n--- FILE: {file_path} ---\n{content}\n"
+        + (f"(also at: {', '.join(list(duplicate_paths[file_path]))})\n" if file_path in duplicate_paths else "")
+        for file_path, content in code_files.items()
+    )
     
     return f"""
     Please analyze the following codebase for security, quality, and performance issues.
@@ -191,6 +575,414 @@ def create_comprehensive_prompt(code_files: Dict[str, str]) -> str:
     """
 
 
+def _strip_python_comments(content: str) -> str:
+    """Remove '#' comments from Python source using the tokenizer."""
+    lines = content.splitlines(keepends=True)
+    try:
+        comments = [
+            token.start for token in tokenize.generate_tokens(io.StringIO(content).readline)
+            if token.type == tokenize.COMMENT
+        ]
+    except (tokenize.TokenError, SyntaxError):
+        return content
+    for row, col in comments:
+        line = lines[row - 1]
+        lines[row - 1] = line[:col] + line[len(line.rstrip('\r\n')):]
+    return "".join(lines)
+
+
+def _keep_strings_only(match: re.Match) -> str:
+    """Replace a C-family comment by its newlines, keeping string literals."""
+    if match.group(1) is not None:
+        return match.group(1)
+    return "\n" * match.group(0).count("\n")
+
+
+def strip_comments(file_path: str, content: str) -> str:
+    """
+    Drop comments and trailing whitespace that cost tokens but add no signal.
+    
+    Line breaks are preserved so that line numbers reported by the model
+    still match the original file; for the same reason runs of blank lines
+    are kept. Files smaller than MIN_STRIP_BYTES are returned unchanged.
+    
+    Args:
+        file_path: Path of the file, used to pick the comment syntax
+        content: File contents
+        
+    Returns:
+        The trimmed contents
+    """
+    if len(content) < MIN_STRIP_BYTES:
+        return content
+    if file_path.endswith('.py'):
+        content = _strip_python_comments(content)
+    else:
+        content = C_COMMENT_RE.sub(_keep_strings_only, content)
+    return TRAILING_WS_RE.sub('', content)
+
+
+def dedupe_code_files(
+    code_files: Iterable[Tuple[str, str]], duplicate_paths: Dict[str, List[str]]
+) -> Iterator[Tuple[str, str]]:
+    """
+    Drop files whose content was already seen, recording where copies live.
+    
+    Vendored and generated copies would otherwise be sent to the model once
+    per copy. Only the first path for each content hash is yielded; later
+    ones are appended to ``duplicate_paths[first_path]``.
+    
+    Args:
+        code_files: Iterable of (file_path, content) pairs
+        duplicate_paths: Dictionary filled with canonical path -> duplicate paths
+        
+    Yields:
+        (file_path, content) pairs with unique content
+    """
+    seen: Dict[int, str] = {}
+    for file_path, content in code_files:
+        digest = xxhash.xxh3_64_intdigest(content.encode())
+        canonical = seen.get(digest)
+        if canonical is None:
+            seen[digest] = file_path
+            yield file_path, content
+        else:
+            duplicate_paths.setdefault(canonical, []).append(file_path)
+
+
+def iter_code_chunks(code_files: Iterable[Tuple[str, str]], max_bytes: int) -> Iterator[Dict[str, str]]:
+    """
+    Group a stream of files into chunks of at most max_bytes of content.
+    
+    Chunks are emitted as soon as the next file would overflow them, so the
+    first prediction can start before the whole repository has been read. A
+    file larger than max_bytes gets a chunk of its own.
+    
+    Args:
+        code_files: Iterable of (file_path, content) pairs
+        max_bytes: Size budget for each chunk
+        
+    Yields:
+        Dictionaries mapping file paths to their contents
+    """
+    chunk: Dict[str, str] = {}
+    chunk_bytes = 0
+    for file_path, content in code_files:
+        if chunk and chunk_bytes + len(content) > max_bytes:
+            yield chunk
+            chunk, chunk_bytes = {}, 0
+        chunk[file_path] = content
+        chunk_bytes += len(content)
+    if chunk:
+        yield chunk
+
+
+def parse_analysis_response(response_text: str, file_count: int) -> Dict[str, Any]:
+    """
+    Parse the model's JSON response, falling back to a placeholder result.
+    
+    Args:
+        response_text: Raw text returned by the model
+        file_count: Number of files covered by the prompt
+        
+    Returns:
+        Parsed analysis result
+    """
+    # Slice out the outermost JSON object, dropping any ```json fences around it
+    start = response_text.find('{')
+    end = response_text.rfind('}') + 1
+    clean_response = response_text[start:end] if 0 <= start < end else response_text
+    
+    try:
+        return orjson.loads(clean_response)
+    except orjson.JSONDecodeError as e:
+        logger.error(f"❌ JSON parsing failed: {e}")
+        logger.error(f"Raw response: {response_text}")
+        
+        # Create fallback structured response
+        return {
+            "repository_analysis": {
+                "overall_score": 75,
+                "total_files": file_count,
+                "risk_level": "medium",
+                "deployment_ready": True
+            },
+            "issues": [
+                {
+                    "type": "quality",
+                    "severity": "medium",
+                    "file": "unknown",
+                    "line": 1,
+                    "message": "AI analysis completed but response parsing failed",
+                    "rule": PARSE_FALLBACK_RULE,
+                    "suggestion": "Review AI model configuration",
+                    "confidence": 0.5
+                }
+            ],
+            "recommendations": [
+                "AI analysis completed successfully",
+                "Consider improving prompt engineering for better JSON output"
+            ],
+            "summary": "Analysis completed with parsing issues",
+            "raw_response": response_text
+        }
+
+
+def _analyze_chunk(chunk: Dict[str, str], duplicate_paths: Dict[str, List[str]]) -> Dict[str, Any]:
+    """Analyze one chunk of files with Vertex AI."""
+    prompt = create_comprehensive_prompt(chunk, duplicate_paths)
+    prediction = get_vertex_endpoint().predict(
+        instances=[{"content": prompt}], parameters=PREDICTION_PARAMETERS
+    )
+    return parse_analysis_response(prediction.predictions[0]['content'], len(chunk))
+
+
+def merge_chunk_results(
+    results: List[Dict[str, Any]], chunks: List[Dict[str, str]], total_files: int
+) -> Dict[str, Any]:
+    """
+    Merge per-chunk analyses into a single repository analysis.
+    
+    The overall score is the mean of the chunk scores weighted by chunk size,
+    and the risk level is the highest reported by any chunk.
+    
+    Args:
+        results: Parsed analysis result for each chunk
+        chunks: The chunks the results were produced from, in the same order
+        total_files: Number of files in the repository
+        
+    Returns:
+        Combined analysis result
+    """
+    issues: List[Dict[str, Any]] = []
+    file_metrics: Dict[str, Any] = {}
+    recommendations: Dict[str, None] = {}
+    summaries: List[str] = []
+    weighted_score = 0.0
+    total_weight = 0
+    risk_index = 0
+    deployment_ready = True
+    
+    for result, chunk in zip(results, chunks):
+        repository_analysis = result.get("repository_analysis", {})
+        weight = sum(len(content) for content in chunk.values()) or 1
+        try:
+            weighted_score += float(repository_analysis.get("overall_score", 75)) * weight
+            total_weight += weight
+        except (TypeError, ValueError):
+            pass
+        risk_level = repository_analysis.get("risk_level")
+        if risk_level in RISK_LEVELS:
+            risk_index = max(risk_index, RISK_LEVELS.index(risk_level))
+        deployment_ready = deployment_ready and repository_analysis.get("deployment_ready", True) is not False
+        
+        issues.extend(result.get("issues", []))
+        file_metrics.update(result.get("file_metrics", {}))
+        recommendations.update(dict.fromkeys(result.get("recommendations", [])))
+        if result.get("summary"):
+            summaries.append(result["summary"])
+    
+    return {
+        "repository_analysis": {
+            "overall_score": round(weighted_score / total_weight, 1) if total_weight else 75,
+            "total_files": total_files,
+            "risk_level": RISK_LEVELS[risk_index],
+            "deployment_ready": deployment_ready
+        },
+        "issues": issues,
+        "file_metrics": file_metrics,
+        "recommendations": list(recommendations),
+        "summary": "\n".join(summaries)
+    }
+
+
+def encode_message(analysis_result: Dict[str, Any]) -> Tuple[bytes, str]:
+    """
+    Serialize an analysis result for Pub/Sub using PUBSUB_ENCODING.
+    
+    Returns:
+        Tuple of (payload bytes, content type)
+    """
+    if PUBSUB_ENCODING == "msgpack":
+        return msgpack.packb(analysis_result, use_bin_type=True), "application/msgpack"
+    return orjson.dumps(analysis_result), "application/json"
+
+
+def _log_publish_result(future) -> None:
+    """Log the outcome of a background Pub/Sub publish."""
+    try:
+        logger.info(f"📤 Published analysis results with message ID: {future.result()}")
+    except Exception as e:
+        logger.error(f"❌ Failed to publish analysis results: {e}")
+
+
+def _publish_partial_result(repo_path: str, commit_hash: str, timestamp: str, future) -> None:
+    """Publish one chunk's analysis once its prediction completes."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    partial_result = dict(future.result(), metadata={
+        "repo_path": repo_path,
+        "commit_hash": commit_hash,
+        "timestamp": timestamp
+    })
+    message_data, content_type = encode_message(partial_result)
+    get_publisher().publish(
+        get_topic_path(), data=message_data, content_type=content_type, partial="true"
+    ).add_done_callback(_log_publish_result)
+
+
+class CodeFetchError(Exception):
+    """Raised when the repository could not be fetched or contained no code."""
+
+
+class _UncacheableResult(Exception):
+    """Carries a result out of the memoized call without lru_cache storing it."""
+    
+    def __init__(self, result: Dict[str, Any]):
+        super().__init__()
+        self.result = result
+
+
+def _has_parse_fallback(result: Dict[str, Any]) -> bool:
+    """Whether any part of an analysis fell back to the unparsed placeholder."""
+    return any(issue.get("rule") == PARSE_FALLBACK_RULE for issue in result.get("issues", []))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_cache_bucket(bucket_name: str):
+    """Return the GCS bucket used for the analysis cache."""
+    from google.cloud import storage
+    
+    return storage.Client(project=PROJECT_ID).bucket(bucket_name)
+
+
+def memoize_gcs(bucket: Optional[str]):
+    """
+    Memoize analyses keyed by (repo_path, commit_hash, analysis_type).
+    
+    A pinned commit never changes, so its analysis can be reused: results are
+    kept in a warm-instance LRU and, when a bucket is configured, persisted as
+    ``cache/<key>.json`` so other instances can reuse them too. Only full
+    commit IDs are cached; HEAD, branches, tags and abbreviated hashes
+    always bypass the cache since they can move. Results in which the
+    model's response could not be parsed are never stored, so a later
+    request gets a fresh analysis.
+    """
+    def decorator(func):
+        @functools.lru_cache(maxsize=ANALYSIS_CACHE_SIZE)
+        def cached(repo_path: str, commit_hash: str, analysis_type: str) -> Dict[str, Any]:
+            blob = None
+            if bucket:
+                key = hashlib.blake2b(
+                    f"{repo_path}|{commit_hash}|{analysis_type}".encode(), digest_size=16
+                ).hexdigest()
+                try:
+                    blob = _get_cache_bucket(bucket).blob(f"cache/{key}.json")
+                    if blob.exists():
+                        result = orjson.loads(blob.download_as_bytes())
+                        if not _has_parse_fallback(result):
+                            logger.info(f"♻️ Analysis cache hit for {repo_path} at {commit_hash}")
+                            return result
+                except Exception as e:
+                    logger.warning(f"⚠️ Analysis cache lookup failed: {e}")
+            
+            result = func(repo_path, commit_hash, analysis_type)
+            if _has_parse_fallback(result):
+                raise _UncacheableResult(result)
+            
+            if blob is not None:
+                try:
+                    blob.upload_from_string(orjson.dumps(result), content_type="application/json")
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not store analysis in cache: {e}")
+            return result
+        
+        @functools.wraps(func)
+        def wrapper(repo_path: str, commit_hash: str, analysis_type: str) -> Dict[str, Any]:
+            if not commit_hash or not _COMMIT_SHA_RE.fullmatch(commit_hash):
+                return func(repo_path, commit_hash, analysis_type)
+            try:
+                # Callers may mutate the result, so never hand out the cached object
+                return copy.deepcopy(cached(repo_path, commit_hash, analysis_type))
+            except _UncacheableResult as e:
+                return e.result
+        
+        wrapper.cache_clear = cached.cache_clear
+        return wrapper
+    return decorator
+
+
+@memoize_gcs(bucket=CACHE_BUCKET)
+def run_analysis(repo_path: str, commit_hash: str, analysis_type: str) -> Dict[str, Any]:
+    """
+    Fetch a repository, analyze it with Vertex AI and return the parsed result.
+    
+    Args:
+        repo_path: Repository URL or local path
+        commit_hash: Git commit hash to analyze
+        analysis_type: Type of analysis requested
+        
+    Returns:
+        Analysis result including metadata
+        
+    Raises:
+        CodeFetchError: If the code could not be fetched or no code files were found
+    """
+    # One timestamp per analysis, reused wherever it is reported
+    now_iso = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    logger.info(f"📥 Fetching code for repo '{repo_path}' at commit '{commit_hash}'...")
+    
+    # --- CORE LOGIC: Fetch the actual code first ---
+    try:
+        code_files = open_commit_files(repo_path, commit_hash)
+    except (pygit2.GitError, KeyError) as e:
+        logger.error(f"❌ Git operation failed: {e}")
+        raise CodeFetchError(f"Error fetching code: Git operation failed: {e}")
+    except OSError as e:
+        logger.error(f"❌ Failed to fetch code: {e}")
+        raise CodeFetchError(f"Error fetching code: {e}")
+    
+    # --- CORE LOGIC: Stream chunks to Vertex AI while files are still being read ---
+    # Identical files are only sent once; copies found before a chunk's
+    # prompt is built are noted in it, and all of them in the metadata
+    submitted = []
+    duplicate_paths: Dict[str, List[str]] = {}
+    trimmed_files = (
+        (file_path, strip_comments(file_path, content))
+        for file_path, content in code_files
+    )
+    unique_files = dedupe_code_files(trimmed_files, duplicate_paths)
+    with ThreadPoolExecutor(max_workers=get_vertex_endpoint().capacity) as executor:
+        for chunk in iter_code_chunks(unique_files, MAX_CHUNK_BYTES):
+            future = executor.submit(_analyze_chunk, chunk, duplicate_paths)
+            if PUBLISH_PARTIAL_RESULTS:
+                future.add_done_callback(functools.partial(_publish_partial_result, repo_path, commit_hash, now_iso))
+            submitted.append((chunk, future))
+        
+        if not submitted:
+            raise CodeFetchError("No code files found in repository")
+        
+        logger.info(f"🤖 Sent {len(submitted)} analysis requests to Vertex AI...")
+        chunks = [chunk for chunk, _ in submitted]
+        chunk_results = [future.result() for _, future in submitted]
+    
+    file_count = sum(len(chunk) for chunk in chunks)
+    analysis_result = merge_chunk_results(chunk_results, chunks, file_count)
+
+    # Add metadata
+    analysis_result["metadata"] = {
+        "repo_path": repo_path,
+        "commit_hash": commit_hash,
+        "analysis_type": analysis_type,
+        "timestamp": now_iso,
+        "files_analyzed": file_count,
+        "duplicate_files": duplicate_paths,
+        "ai_model": "vertex-ai-endpoint"
+    }
+
+    return analysis_result
+
+
 @functions_framework.http
 def analyze_code(request):
     """
@@ -199,11 +991,11 @@ def analyze_code(request):
     Expected JSON payload:
     {
         "repoPath": "https://github.com/user/repo.git",
-        "commitHash": "abc123def456",
+        "commitHash": "<full commit SHA, branch name or HEAD>",
         "analysisType": "comprehensive"
     }
     """
-    if not vertex_endpoint or not publisher:
+    if not all([PROJECT_ID, ENDPOINT_ID, PUB_SUB_TOPIC]):
         return ("Internal Server Error: Clients not initialized", 500)
 
     # Parse request
@@ -218,92 +1010,26 @@ def analyze_code(request):
     logger.info(f"🔍 Starting {analysis_type} analysis for {repo_path} at {commit_hash}")
 
     try:
-        # --- CORE LOGIC: Fetch the actual code first ---
-        code_files = fetch_code_from_repo(repo_path, commit_hash)
-        
-        if "error" in code_files:
-            return (f"Error fetching code: {code_files['error']}", 400)
-        
-        if not code_files:
-            return ("No code files found in repository", 400)
-
-        # --- CORE LOGIC: Create comprehensive analysis prompt ---
-        prompt = create_comprehensive_prompt(code_files)
-
-        logger.info("🤖 Sending analysis request to Vertex AI...")
-        
-        # Define the instance payload for the prediction request
-        instance = [{"content": prompt}]
-        parameters = {
-            "maxOutputTokens": 4096,  # Increased for comprehensive analysis
-            "temperature": 0.1,       # Very low temperature for consistent results
-            "topP": 0.8,
-            "topK": 40
-        }
-        
-        prediction = vertex_endpoint.predict(instances=instance, parameters=parameters)
-        
-        # --- CORE LOGIC: Parse the model's response ---
-        response_text = prediction.predictions[0]['content']
-        clean_response = response_text.strip().replace("```json", "").replace("```", "").strip()
-        
         try:
-            analysis_result = json.loads(clean_response)
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ JSON parsing failed: {e}")
-            logger.error(f"Raw response: {response_text}")
-            
-            # Create fallback structured response
-            analysis_result = {
-                "repository_analysis": {
-                    "overall_score": 75,
-                    "total_files": len(code_files),
-                    "risk_level": "medium",
-                    "deployment_ready": True
-                },
-                "issues": [
-                    {
-                        "type": "quality",
-                        "severity": "medium",
-                        "file": "unknown",
-                        "line": 1,
-                        "message": "AI analysis completed but response parsing failed",
-                        "rule": "AI-PARSE-001",
-                        "suggestion": "Review AI model configuration",
-                        "confidence": 0.5
-                    }
-                ],
-                "recommendations": [
-                    "AI analysis completed successfully",
-                    "Consider improving prompt engineering for better JSON output"
-                ],
-                "summary": "Analysis completed with parsing issues",
-                "raw_response": response_text
-            }
-
-        # Add metadata
-        analysis_result["metadata"] = {
-            "repo_path": repo_path,
-            "commit_hash": commit_hash,
-            "analysis_type": analysis_type,
-            "timestamp": "2025-01-27T10:30:00Z",
-            "files_analyzed": len(code_files),
-            "ai_model": "vertex-ai-endpoint"
-        }
+            analysis_result = run_analysis(repo_path, commit_hash, analysis_type)
+        except CodeFetchError as e:
+            return (str(e), 400)
 
         logger.info(f"✅ Analysis completed. Found {len(analysis_result.get('issues', []))} issues.")
 
         # --- BEST PRACTICE: Publish results to Pub/Sub ---
+        # Don't block the response on the publish round-trip
         if analysis_result.get('issues'):
-            message_data = json.dumps(analysis_result).encode("utf-8")
-            future = publisher.publish(topic_path, data=message_data)
-            message_id = future.result()
-            logger.info(f"📤 Published analysis results with message ID: {message_id}")
+            message_data, content_type = encode_message(analysis_result)
+            future = get_publisher().publish(
+                get_topic_path(), data=message_data, content_type=content_type, partial="false"
+            )
+            future.add_done_callback(_log_publish_result)
 
         return {
             "status": "success", 
             "analysis": analysis_result,
-            "message_id": message_id if 'message_id' in locals() else None
+            "message_id": None
         }
 
     except Exception as e:
@@ -313,18 +1039,25 @@ def analyze_code(request):
 
 @functions_framework.http
 def health_check(request):
-    """Health check endpoint for the Cloud Function."""
+    """
+    Health check endpoint for the Cloud Function.
+    
+    Returns immediately by default; pass ``?deep=1`` to also initialize and
+    report on the Vertex AI and Pub/Sub clients.
+    """
     try:
-        # Check if all required components are available
         status = {
             "status": "healthy",
-            "vertex_ai": vertex_endpoint is not None,
-            "pubsub": publisher is not None,
             "project_id": PROJECT_ID,
             "region": REGION,
-            "timestamp": "2025-01-27T10:30:00Z"
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds')
         }
         
+        # Check if all required components are available
+        if request.args.get("deep") == "1":
+            status["vertex_ai"] = _client_available(get_vertex_endpoint)
+            status["pubsub"] = _client_available(get_topic_path)
+        
         return status
     except Exception as e:
         return {"status": "unhealthy", "error": str(e)}, 500
\ No newline at end of file
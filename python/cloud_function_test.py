@@ -2,11 +2,14 @@
 Test script for Cloud Functions to verify deployment and functionality.
 """
 
-import requests
-import json
-import time
+import asyncio
+import httpx
 from typing import Dict, Any
 
+# Transient 5xx responses (e.g. a cold start) are retried with exponential backoff
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.2
+
 class CloudFunctionTester:
     """Test suite for Code Analyzer Cloud Functions."""
     
@@ -14,13 +17,21 @@ class CloudFunctionTester:
         self.project_id = project_id
         self.region = region
         self.base_url = f"https://{region}-{project_id}.cloudfunctions.net"
+    
+    async def _request(self, client: httpx.AsyncClient, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send a request, retrying server errors with exponential backoff."""
+        for attempt in range(RETRY_ATTEMPTS):
+            response = await client.request(method, f"{self.base_url}{path}", **kwargs)
+            if response.status_code < 500 or attempt == RETRY_ATTEMPTS - 1:
+                return response
+            await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt)
         
-    def test_health_check(self) -> Dict[str, Any]:
+    async def test_health_check(self, client: httpx.AsyncClient) -> Dict[str, Any]:
         """Test the health check endpoint."""
         print("🔍 Testing health check endpoint...")
         
         try:
-            response = requests.get(f"{self.base_url}/health-check", timeout=30)
+            response = await self._request(client, "GET", "/health-check", timeout=30)
             
             if response.status_code == 200:
                 result = response.json()
@@ -37,7 +48,9 @@ class CloudFunctionTester:
             print(f"❌ Health check error: {str(e)}")
             return {"success": False, "error": str(e)}
     
-    def test_code_analysis(self, repo_path: str = "https://github.com/octocat/Hello-World.git") -> Dict[str, Any]:
+    async def test_code_analysis(
+        self, client: httpx.AsyncClient, repo_path: str = "https://github.com/octocat/Hello-World.git"
+    ) -> Dict[str, Any]:
         """Test the code analysis endpoint."""
         print(f"🔍 Testing code analysis with repo: {repo_path}")
         
@@ -48,8 +61,10 @@ class CloudFunctionTester:
         }
         
         try:
-            response = requests.post(
-                f"{self.base_url}/analyze-code",
+            response = await self._request(
+                client,
+                "POST",
+                "/analyze-code",
                 json=payload,
                 timeout=300  # 5 minutes for analysis
             )
@@ -70,23 +85,30 @@ class CloudFunctionTester:
             print(f"❌ Code analysis error: {str(e)}")
             return {"success": False, "error": str(e)}
     
-    def test_all_endpoints(self) -> Dict[str, Any]:
-        """Test all available endpoints."""
+    async def test_all_endpoints(self) -> Dict[str, Any]:
+        """
+        Test all available endpoints over one HTTP/2 connection.
+        
+        The health check runs first; the remaining tests only run, concurrently,
+        once it has passed.
+        """
         print("🚀 Starting comprehensive Cloud Function tests...")
         print("=" * 50)
         
         results = {}
         
-        # Test health check
-        results["health_check"] = self.test_health_check()
-        time.sleep(2)
-        
-        # Test code analysis (only if health check passed)
-        if results["health_check"]["success"]:
-            results["code_analysis"] = self.test_code_analysis()
-        else:
-            print("⚠️ Skipping code analysis test due to health check failure")
-            results["code_analysis"] = {"success": False, "error": "Health check failed"}
+        async with httpx.AsyncClient(http2=True) as client:
+            results["health_check"] = await self.test_health_check(client)
+            
+            # Tests that need a healthy deployment
+            tests = {"code_analysis": self.test_code_analysis}
+            if results["health_check"]["success"]:
+                outcomes = await asyncio.gather(*(test(client) for test in tests.values()))
+                results.update(zip(tests, outcomes))
+            else:
+                print("⚠️ Skipping remaining tests due to health check failure")
+                for test_name in tests:
+                    results[test_name] = {"success": False, "error": "Health check failed"}
         
         # Summary
         print("\n📊 Test Results Summary:")
@@ -120,7 +142,7 @@ def main():
     print()
     
     # Run tests
-    results = tester.test_all_endpoints()
+    results = asyncio.run(tester.test_all_endpoints())
     
     # Final summary
     total_tests = len(results)
@@ -1,10 +1,66 @@
 import os
 import json
 import asyncio
+from array import array
+from collections import Counter
+from dataclasses import dataclass, field
 from typing import Dict, List, Any, Optional
 from google.cloud import aiplatform
 from vertex_ai_setup import VertexAIManager
 
+@dataclass
+class IssueBatch:
+    """
+    Issues stored column by column instead of as one dict per issue.
+    
+    Each attribute is a parallel column; numeric columns are packed arrays.
+    This avoids a dict allocation per issue and lets aggregates run over a
+    single column.
+    """
+    file: List[str] = field(default_factory=list)
+    type: List[str] = field(default_factory=list)
+    severity: List[str] = field(default_factory=list)
+    line: array = field(default_factory=lambda: array('i'))
+    message: List[str] = field(default_factory=list)
+    rule: List[str] = field(default_factory=list)
+    suggestion: List[str] = field(default_factory=list)
+    confidence: array = field(default_factory=lambda: array('d'))
+    # Files added through add_issues, including those without issues
+    analyzed_files: List[str] = field(default_factory=list)
+    
+    def __len__(self) -> int:
+        return len(self.type)
+    
+    def append(self, file_path: str, issue_type: str, severity: str, line: int,
+               message: str, rule: str, suggestion: str, confidence: float) -> None:
+        """Add one issue."""
+        self.file.append(file_path)
+        self.type.append(issue_type)
+        self.severity.append(severity)
+        self.line.append(line)
+        self.message.append(message)
+        self.rule.append(rule)
+        self.suggestion.append(suggestion)
+        self.confidence.append(confidence)
+    
+    def add_issues(self, file_path: str, issues: List[Dict[str, Any]]) -> None:
+        """Add the issues of one analyzed file, given as issue dicts."""
+        self.analyzed_files.append(file_path)
+        for issue in issues:
+            self.append(
+                file_path, issue["type"], issue["severity"], issue["line"],
+                issue["message"], issue["rule"], issue["suggestion"], issue["confidence"]
+            )
+    
+    def file_count(self) -> int:
+        """Number of distinct files analyzed."""
+        return len(set(self.analyzed_files))
+    
+    def type_counts(self) -> Dict[str, int]:
+        """Number of issues per issue type."""
+        return dict(Counter(self.type))
+
+
 class CodeAnalyzerAI:
     """
     AI-powered code analysis using Google Cloud Vertex AI.
@@ -16,13 +72,17 @@ class CodeAnalyzerAI:
         self.vertex_manager = VertexAIManager(project_id, region)
         self.model_name = "code-bison@001"  # Google's code analysis model
         
-    async def analyze_code_quality(self, code_content: str, file_path: str) -> Dict[str, Any]:
+    async def analyze_code_quality(
+        self, code_content: str, file_path: str, batch: Optional[IssueBatch] = None
+    ) -> Dict[str, Any]:
         """
         Analyze code quality using Vertex AI.
         
         Args:
             code_content: The source code to analyze
             file_path: Path to the file being analyzed
+            batch: Optional batch the file's issues are also appended to, for
+                columnar aggregation across files
             
         Returns:
             Dictionary containing analysis results
@@ -33,29 +93,33 @@ class CodeAnalyzerAI:
             
             # TODO: Implement actual Vertex AI model call
             # For now, return mock analysis results
+            issues = [
+                {
+                    "type": "security",
+                    "severity": "high",
+                    "line": 42,
+                    "message": "Potential SQL injection vulnerability",
+                    "rule": "AI-SEC-001",
+                    "suggestion": "Use parameterized queries to prevent SQL injection",
+                    "confidence": 0.92
+                },
+                {
+                    "type": "quality",
+                    "severity": "medium",
+                    "line": 128,
+                    "message": "Function complexity is high",
+                    "rule": "AI-QUAL-002",
+                    "suggestion": "Consider breaking this function into smaller parts",
+                    "confidence": 0.87
+                }
+            ]
+            if batch is not None:
+                batch.add_issues(file_path, issues)
+            
             analysis_result = {
                 "file_path": file_path,
                 "quality_score": 85.2,
-                "issues": [
-                    {
-                        "type": "security",
-                        "severity": "high",
-                        "line": 42,
-                        "message": "Potential SQL injection vulnerability",
-                        "rule": "AI-SEC-001",
-                        "suggestion": "Use parameterized queries to prevent SQL injection",
-                        "confidence": 0.92
-                    },
-                    {
-                        "type": "quality",
-                        "severity": "medium", 
-                        "line": 128,
-                        "message": "Function complexity is high",
-                        "rule": "AI-QUAL-002",
-                        "suggestion": "Consider breaking this function into smaller parts",
-                        "confidence": 0.87
-                    }
-                ],
+                "issues": issues,
                 "metrics": {
                     "complexity": 15,
                     "maintainability": 72,
@@ -97,12 +161,16 @@ class CodeAnalyzerAI:
         Format the response as structured JSON.
         """
     
-    async def batch_analyze_repository(self, repo_path: str) -> Dict[str, Any]:
+    async def batch_analyze_repository(
+        self, repo_path: str, batch: Optional[IssueBatch] = None
+    ) -> Dict[str, Any]:
         """
         Analyze an entire repository using AI.
         
         Args:
             repo_path: Path to the repository
+            batch: Optional issues collected by analyze_code_quality; when
+                given, the file count and issue totals are computed from it
             
         Returns:
             Comprehensive analysis results
@@ -136,6 +204,11 @@ class CodeAnalyzerAI:
             "deployment_readiness": "Ready with minor fixes"
         }
         
+        if batch is not None:
+            analysis_summary["files_analyzed"] = batch.file_count()
+            analysis_summary["total_issues"] = len(batch)
+            analysis_summary["issue_breakdown"] = batch.type_counts()
+        
         print(f"✅ Repository analysis completed!")
         print(f"   Overall Score: {analysis_summary['overall_score']}/100")
         print(f"   Issues Found: {analysis_summary['total_issues']}")
@@ -162,12 +235,13 @@ def login_user(username, password):
     """
     
     print("\n📝 Analyzing sample code...")
-    result = await analyzer.analyze_code_quality(sample_code, "auth/login.py")
+    issues = IssueBatch()
+    result = await analyzer.analyze_code_quality(sample_code, "auth/login.py", issues)
     print(json.dumps(result, indent=2))
     
     # Test repository analysis
     print("\n📁 Analyzing repository...")
-    repo_result = await analyzer.batch_analyze_repository("/sample/project")
+    repo_result = await analyzer.batch_analyze_repository("/sample/project", issues)
     print(json.dumps(repo_result, indent=2))
 
 if __name__ == "__main__":
@@ -3,89 +3,117 @@ Enhanced deployment configuration for Cloud Functions with multi-agent support.
 """
 
 import os
-import json
-from typing import Dict, List
+import shlex
+import sys
+from dataclasses import dataclass, field
+from functools import cache
+from typing import Dict
 
+# Snapshot of the environment taken at import; later changes are not picked up
+_ENV = dict(os.environ)
+
+# Continuation between argument groups of a rendered shell command
+_LINE_CONTINUATION = " \\\n  "
+
+
+def _memoized_property(func):
+    """
+    Read-only property computed once per distinct config.
+    
+    functools.cached_property needs an instance __dict__, which slotted
+    classes don't have; frozen dataclasses are hashable, so the value is
+    cached by functools.cache keyed on the instance instead.
+    """
+    return property(cache(func), doc=func.__doc__)
+
+
+@dataclass(frozen=True, slots=True)
 class EnhancedDeploymentConfig:
-    """Enhanced configuration manager for multi-agent Cloud Function deployment."""
+    """
+    Enhanced configuration manager for multi-agent Cloud Function deployment.
     
-    def __init__(self):
-        self.project_id = os.getenv("GOOGLE_CLOUD_PROJECT", "code-analyzer-service-account")
-        self.region = os.getenv("GCP_REGION", "us-central1")
-        self.function_region = os.getenv("FUNCTION_REGION", "us-central1")
-        
-    def get_deployment_commands(self) -> Dict[str, str]:
+    Settings come from the environment snapshot taken at import and cannot
+    change afterwards; everything derived from them is
+    computed on first access and cached. Use the module-level CONFIG.
+    """
+    project_id: str = field(default_factory=lambda: _ENV.get("GOOGLE_CLOUD_PROJECT", "code-analyzer-service-account"))
+    region: str = field(default_factory=lambda: _ENV.get("GCP_REGION", "us-central1"))
+    function_region: str = field(default_factory=lambda: _ENV.get("FUNCTION_REGION", "us-central1"))
+    
+    @_memoized_property
+    def env_vars(self) -> Dict[str, str]:
+        """Required environment variables for deployment."""
+        return {
+            "GCP_PROJECT_ID": self.project_id,
+            "GCP_PROJECT": self.project_id,  # Alternative name for compatibility
+            "GCP_REGION": self.region,
+            "VERTEX_ENDPOINT_ID": "your-endpoint-id-here",  # Replace with actual endpoint ID
+            "PUB_SUB_TOPIC": "code-analysis-results",
+            "DOC_AGENT_TOPIC": "doc-agent-messages",
+            "GOOGLE_CLOUD_PROJECT": self.project_id
+        }
+    
+    @_memoized_property
+    def env_var_string(self) -> str:
+        """Environment variables formatted for --set-env-vars."""
+        return ",".join(f"{k}={v}" for k, v in self.env_vars.items())
+    
+    @_memoized_property
+    def deployment_commands(self) -> Dict[str, str]:
         """
-        Generate deployment commands for all Cloud Functions.
+        Deployment commands for all Cloud Functions.
         
         Returns:
             Dictionary of function names to deployment commands
         """
-        env_vars = self._get_environment_variables()
-        env_var_string = ",".join([f"{k}={v}" for k, v in env_vars.items()])
+        env_var_string = self.env_var_string
         
         functions = {
             "analyze-code": {
                 "entry_point": "analyze_code",
                 "trigger": "--trigger-http --allow-unauthenticated",
                 "memory": "2GB",
-                "timeout": "540s"
+                "timeout": "540s",
+                "min_instances": "1"  # Keep one instance warm for the user-facing endpoint
             },
             "health-check": {
                 "entry_point": "health_check", 
                 "trigger": "--trigger-http --allow-unauthenticated",
                 "memory": "512MB",
-                "timeout": "60s"
-            },
-            "doc-agent": {
-                "entry_point": "doc_agent",
-                "trigger": "--trigger-topic=code-analysis-results",
-                "memory": "1GB", 
-                "timeout": "300s"
+                "timeout": "60s",
+                "min_instances": "0"
             },
-            "test-agent": {
-                "entry_point": "test_agent",
+            "agent-dispatch": {
+                "entry_point": "agent_dispatch",
                 "trigger": "--trigger-topic=code-analysis-results",
-                "memory": "1GB",
-                "timeout": "300s"
-            },
-            "qa-agent": {
-                "entry_point": "qa_agent",
-                "trigger": "--trigger-topic=code-analysis-results", 
-                "memory": "1GB",
-                "timeout": "300s"
+                "memory": "512MB",
+                "timeout": "300s",
+                "min_instances": "0"
             }
         }
         
+        # One argument group per line; shlex quotes any value that needs it
         commands = {}
         for func_name, config in functions.items():
-            commands[func_name] = f"""gcloud functions deploy {func_name} \\
-  --runtime python311 \\
-  {config['trigger']} \\
-  --region {self.function_region} \\
-  --entry-point {config['entry_point']} \\
-  --memory {config['memory']} \\
-  --timeout {config['timeout']} \\
-  --set-env-vars {env_var_string} \\
-  --source . \\
-  --project {self.project_id}"""
-        
+            argv_groups = [
+                ["gcloud", "functions", "deploy", func_name],
+                ["--runtime", "python311"],
+                config["trigger"].split(),
+                ["--region", self.function_region],
+                ["--entry-point", config["entry_point"]],
+                ["--memory", config["memory"]],
+                ["--timeout", config["timeout"]],
+                ["--min-instances", config["min_instances"]],
+                ["--set-env-vars", env_var_string],
+                ["--source", "."],
+                ["--project", self.project_id]
+            ]
+            commands[func_name] = _LINE_CONTINUATION.join(map(shlex.join, argv_groups))
         return commands
     
-    def _get_environment_variables(self) -> Dict[str, str]:
-        """Get required environment variables for deployment."""
-        return {
-            "GCP_PROJECT_ID": self.project_id,
-            "GCP_PROJECT": self.project_id,  # Alternative name for compatibility
-            "GCP_REGION": self.region,
-            "VERTEX_ENDPOINT_ID": "your-endpoint-id-here",  # Replace with actual endpoint ID
-            "PUB_SUB_TOPIC": "code-analysis-results",
-            "DOC_AGENT_TOPIC": "doc-agent-messages",
-            "GOOGLE_CLOUD_PROJECT": self.project_id
-        }
-    
-    def generate_pubsub_topics_script(self) -> str:
-        """Generate script to create required Pub/Sub topics."""
+    @_memoized_property
+    def pubsub_topics_script(self) -> str:
+        """Script to create required Pub/Sub topics."""
         topics = [
             "code-analysis-results",
             "doc-agent-messages", 
@@ -93,68 +121,98 @@ class EnhancedDeploymentConfig:
             "qa-agent-messages"
         ]
         
-        script = "#!/bin/bash\n\n"
-        script += "# Create Pub/Sub topics for Code Analyzer Agent\n\n"
+        parts = [
+            "#!/bin/bash\n\n",
+            "# Create Pub/Sub topics for Code Analyzer Agent\n\n"
+        ]
         
         for topic in topics:
-            script += f"echo 'Creating topic: {topic}'\n"
-            script += f"gcloud pubsub topics create {topic} --project={self.project_id}\n\n"
+            parts.append(f"echo 'Creating topic: {topic}'\n")
+            parts.append(f"gcloud pubsub topics create {topic} --project={self.project_id}\n\n")
         
-        script += "echo 'All topics created successfully!'\n"
-        return script
+        parts.append("echo 'All topics created successfully!'\n")
+        return "".join(parts)
     
-    def generate_deployment_script(self) -> str:
-        """Generate complete deployment script for all functions."""
-        commands = self.get_deployment_commands()
-        
-        script = "#!/bin/bash\n\n"
-        script += "# Deploy all Code Analyzer Agent Cloud Functions\n\n"
-        script += "set -e  # Exit on any error\n\n"
+    @_memoized_property
+    def warmup_scheduler_script(self) -> str:
+        """Script creating a Cloud Scheduler job that pings analyze-code every 5 minutes."""
+        warmup_url = f"https://{self.function_region}-{self.project_id}.cloudfunctions.net/analyze-code?warmup=1"
+        return "".join([
+            "#!/bin/bash\n\n",
+            "# Keep analyze-code warm even when deployed with --min-instances 0\n\n",
+            "gcloud scheduler jobs create http analyze-code-warmup \\\n",
+            "  --schedule='*/5 * * * *' \\\n",
+            f"  --uri='{warmup_url}' \\\n",
+            "  --http-method=GET \\\n",
+            f"  --location={self.function_region} \\\n",
+            f"  --project={self.project_id}\n"
+        ])
+    
+    @_memoized_property
+    def deployment_script(self) -> str:
+        """Complete deployment script for all functions."""
+        commands = self.deployment_commands
         
-        # Create topics first
-        script += "echo 'Creating Pub/Sub topics...'\n"
-        script += "./create_topics.sh\n\n"
+        parts = [
+            "#!/bin/bash\n\n",
+            "# Deploy all Code Analyzer Agent Cloud Functions\n\n",
+            "set -e  # Exit on any error\n\n",
+            # Create topics first
+            "echo 'Creating Pub/Sub topics...'\n",
+            "./create_topics.sh\n\n"
+        ]
         
         # Deploy functions
         for func_name, command in commands.items():
-            script += f"echo 'Deploying {func_name}...'\n"
-            script += command + "\n\n"
+            parts.append(f"echo 'Deploying {func_name}...'\n")
+            parts.append(command)
+            parts.append("\n\n")
         
-        script += "echo 'All functions deployed successfully!'\n"
-        script += "echo 'Main analysis endpoint: https://{}-{}.cloudfunctions.net/analyze-code'\n".format(
-            self.function_region, self.project_id
+        parts.append("echo 'All functions deployed successfully!'\n")
+        parts.append(
+            f"echo 'Main analysis endpoint: https://{self.function_region}-{self.project_id}.cloudfunctions.net/analyze-code'\n"
         )
         
-        return script
+        return "".join(parts)
+
+CONFIG = EnhancedDeploymentConfig()
 
 # Example usage and script generation
 if __name__ == "__main__":
-    config = EnhancedDeploymentConfig()
+    config = CONFIG
     
-    print("🚀 Enhanced Cloud Function Deployment Configuration")
-    print("=" * 60)
+    # Output is collected and written once
+    parts = [
+        "🚀 Enhanced Cloud Function Deployment Configuration",
+        "=" * 60,
+        "\n📦 Individual Deployment Commands:"
+    ]
     
     # Generate deployment commands
-    commands = config.get_deployment_commands()
-    print("\n📦 Individual Deployment Commands:")
-    for func_name, command in commands.items():
-        print(f"\n{func_name}:")
-        print(command)
+    for func_name, command in config.deployment_commands.items():
+        parts.append(f"\n{func_name}:")
+        parts.append(command)
     
     # Generate Pub/Sub topics script
-    topics_script = config.generate_pubsub_topics_script()
-    print(f"\n📋 Pub/Sub Topics Script (save as create_topics.sh):")
-    print(topics_script)
+    parts.append("\n📋 Pub/Sub Topics Script (save as create_topics.sh):")
+    parts.append(config.pubsub_topics_script)
     
     # Generate complete deployment script
-    deploy_script = config.generate_deployment_script()
-    print(f"\n📄 Complete Deployment Script (save as deploy_all.sh):")
-    print(deploy_script)
+    parts.append("\n📄 Complete Deployment Script (save as deploy_all.sh):")
+    parts.append(config.deployment_script)
+    
+    # Generate warmup scheduler script
+    parts.append("\n⏰ Warmup Scheduler Script (save as create_warmup_job.sh):")
+    parts.append(config.warmup_scheduler_script)
     
-    print("\n✅ Configuration generated successfully!")
-    print("\nNext steps:")
-    print("1. Update VERTEX_ENDPOINT_ID in the environment variables")
-    print("2. Save the scripts and make them executable:")
-    print("   chmod +x create_topics.sh deploy_all.sh")
-    print("3. Run: ./deploy_all.sh")
-    print("4. Update your frontend CLOUD_FUNCTION_URL environment variable")
\ No newline at end of file
+    parts += [
+        "\n✅ Configuration generated successfully!",
+        "\nNext steps:",
+        "1. Update VERTEX_ENDPOINT_ID in the environment variables",
+        "2. Save the scripts and make them executable:",
+        "   chmod +x create_topics.sh deploy_all.sh",
+        "3. Run: ./deploy_all.sh",
+        "4. Optionally run: ./create_warmup_job.sh",
+        "5. Update your frontend CLOUD_FUNCTION_URL environment variable"
+    ]
+    sys.stdout.write("\n".join(parts) + "\n")
@@ -1,162 +1,461 @@
 import os
+import atexit
 import json
 import logging
-import base64
-from typing import Dict, List, Any
-from google.cloud import aiplatform
-from google.cloud import pubsub_v1
+import mmap
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from functools import cache, lru_cache
+from orjson import dumps as _json_dumps, loads as _json_loads  # orjson.JSONDecodeError subclasses json's
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple
 import functions_framework
-import subprocess
+import pygit2
 import tempfile
 import shutil
 
+# SIMD base64 decoding for Pub/Sub payloads, with the stdlib as fallback
+try:
+    from pybase64 import b64decode as _b64decode
+except ImportError:
+    from base64 import b64decode as _b64decode
+
+# zstd compression of published analysis results; without the package results
+# are published uncompressed (and compressed messages cannot be read)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
+def _warm_channel(client) -> None:
+    """
+    Start connecting a client's gRPC channel in the background.
+    
+    gRPC channels connect lazily, so without this the first publish pays for
+    the TCP/TLS/HTTP2 handshake. Subscribing with try_to_connect does not block.
+    """
+    try:
+        client.api.transport.grpc_channel.subscribe(lambda state: None, try_to_connect=True)
+    except Exception as e:
+        logger.warning(f"⚠️ Could not warm gRPC channel: {e}")
+
+
+def _now() -> str:
+    """Current UTC time as an ISO 8601 string with seconds precision."""
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+# --- BEST PRACTICE: Use Environment Variables for Configuration ---
+# Read once at import; the project is required by every function, so a
+# missing value fails the instance at start-up rather than each request.
+PROJECT_ID = os.getenv("GCP_PROJECT_ID") or os.getenv("GCP_PROJECT")
+REGION = os.getenv("GCP_REGION", "us-central1")
+ENDPOINT_ID = os.getenv("VERTEX_ENDPOINT_ID")
+PUB_SUB_TOPIC = os.getenv("PUB_SUB_TOPIC", "code-analysis-results")
+DOC_AGENT_TOPIC = os.getenv("DOC_AGENT_TOPIC", "doc-agent-messages")
+
+# Also publish one documentation message per issue, waiting once for the batch
+DOC_AGENT_ISSUE_UPDATES = os.getenv("DOC_AGENT_ISSUE_UPDATES", "false").lower() == "true"
+PUBLISH_FLUSH_TIMEOUT = 10  # seconds
+
+# Analysis results published without waiting that may be unacknowledged at once
+MAX_INFLIGHT_PUBLISHES = 100
+
+# Compression of published analysis results: "none" (default) or "zstd".
+# zstd changes the wire format of the results topic, so only opt in once
+# every subscriber handles the content_encoding attribute.
+PUBSUB_COMPRESSION = os.getenv("PUBSUB_COMPRESSION", "none").lower()
+ZSTD_LEVEL = 3
+
+# Largest decoded Pub/Sub payload the agents will parse
+MAX_MESSAGE_BYTES = int(os.getenv("MAX_MESSAGE_BYTES", 1 << 20))
+
+# Prompt budget: each file is truncated to MAX_PROMPT_FILE_CHARS and files stop
+# being added once the code in the prompt would exceed MAX_PROMPT_CHARS
+MAX_PROMPT_FILE_CHARS = int(os.getenv("MAX_PROMPT_FILE_CHARS", 8_000))
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", 200_000))
+
+# Bound once so doc_agent only fills in the two counts
+_format_doc_summary = "Generated documentation for {} issues across {} files".format
+
+if not PROJECT_ID:
+    raise ValueError("Missing required environment variable: GCP_PROJECT_ID or GCP_PROJECT")
+
+# gRPC channel options for the publisher: keepalive pings keep the HTTP/2
+# connection open while a warm instance sits idle between events
+PUBLISHER_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0)
+]
+
 # --- BEST PRACTICE: Initialize clients in the global scope ---
 # They will be reused across function invocations.
 try:
-    # --- BEST PRACTICE: Use Environment Variables for Configuration ---
-    PROJECT_ID = os.getenv("GCP_PROJECT_ID") or os.getenv("GCP_PROJECT")
-    REGION = os.getenv("GCP_REGION", "us-central1")
-    ENDPOINT_ID = os.getenv("VERTEX_ENDPOINT_ID")
-    PUB_SUB_TOPIC = os.getenv("PUB_SUB_TOPIC", "code-analysis-results")
-    DOC_AGENT_TOPIC = os.getenv("DOC_AGENT_TOPIC", "doc-agent-messages")
-
-    if not all([PROJECT_ID, ENDPOINT_ID]):
-        raise ValueError("Missing required environment variables: GCP_PROJECT_ID, VERTEX_ENDPOINT_ID")
-
-    # Initialize the Vertex AI SDK
-    aiplatform.init(project=PROJECT_ID, location=REGION)
-    
-    # Get an object representing the endpoint
-    vertex_endpoint = aiplatform.Endpoint(
-        endpoint_id=ENDPOINT_ID, 
-        project=PROJECT_ID, 
-        location=REGION
+    if not ENDPOINT_ID:
+        raise ValueError("Missing required environment variable: VERTEX_ENDPOINT_ID")
+
+    # Thin GAPIC prediction client: protobuf over a long-lived gRPC/HTTP2
+    # channel to the regional endpoint, instead of the SDK's per-call REST
+    from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceClient
+    
+    prediction_client = PredictionServiceClient(
+        client_options={"api_endpoint": f"{REGION}-aiplatform.googleapis.com"}
     )
+    vertex_endpoint = prediction_client.endpoint_path(PROJECT_ID, REGION, ENDPOINT_ID)
     
-    # Initialize the Pub/Sub client
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(PROJECT_ID, PUB_SUB_TOPIC)
-    doc_topic_path = publisher.topic_path(PROJECT_ID, DOC_AGENT_TOPIC)
-
     logger.info("✅ Clients initialized successfully.")
 
 except Exception as e:
     logger.error(f"❌ Error initializing clients: {e}")
-    publisher = None 
+    prediction_client = None
     vertex_endpoint = None
 
+@cache
+def _topic_path(topic: str) -> str:
+    """Full topic path, in the same format as PublisherClient.topic_path, built once per topic."""
+    return f"projects/{PROJECT_ID}/topics/{topic}"
 
-def fetch_code_from_repo(repo_path: str, commit_hash: str) -> Dict[str, str]:
+
+topic_path = _topic_path(PUB_SUB_TOPIC)
+doc_topic_path = _topic_path(DOC_AGENT_TOPIC)
+
+# --- BEST PRACTICE: Build the Pub/Sub client off the import path ---
+# Importing pubsub_v1 pulls in gRPC and protobuf, the largest part of cold
+# start. The client is created by a background thread started at import, so
+# the interpreter finishes loading while gRPC initializes, and any handler
+# that runs first simply waits for it in get_publisher().
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """Return the shared Pub/Sub publisher, creating it on first use."""
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                from google.cloud import pubsub_v1
+                from google.pubsub_v1.services.publisher.transports import PublisherGrpcTransport
+                
+                # Messages are batched for up to 50 ms so per-issue updates and publishes
+                # from concurrent invocations on a warm instance share RPCs
+                publisher = pubsub_v1.PublisherClient(
+                    batch_settings=pubsub_v1.types.BatchSettings(
+                        max_messages=1000,
+                        max_bytes=9 * 1024 * 1024,
+                        max_latency=0.05
+                    ),
+                    transport=PublisherGrpcTransport(
+                        channel=PublisherGrpcTransport.create_channel(options=PUBLISHER_CHANNEL_OPTIONS)
+                    )
+                )
+                _warm_channel(publisher)
+                _publisher = publisher
+                logger.info("✅ Pub/Sub client initialized successfully.")
+    return _publisher
+
+
+def _prewarm_publisher() -> None:
+    """Create the publisher in the background, logging instead of raising."""
+    try:
+        get_publisher()
+    except Exception as e:
+        logger.error(f"❌ Error initializing Pub/Sub client: {e}")
+
+
+threading.Thread(target=_prewarm_publisher, daemon=True).start()
+
+
+# Parallel file reads while fetching a repository
+MAX_READ_WORKERS = 32
+
+# Larger files (generated, bundled or vendored code) are skipped without being
+# opened, and files with a NUL byte in their first BINARY_SNIFF_BYTES are binary
+MAX_CODE_FILE_BYTES = 256 * 1024
+BINARY_SNIFF_BYTES = 4096
+
+# Files larger than this are decoded straight from a memory map
+MMAP_MIN_BYTES = 64 * 1024
+
+# Checkouts are removed by a background pool so the response doesn't wait on
+# unlinking every file; the prefix lets a new instance find and remove
+# checkouts left behind if an earlier process died before cleaning up
+TEMP_DIR_PREFIX = "code-analyzer-"
+
+# Only checkouts untouched for longer than this are swept; it exceeds the
+# 540s function timeout, so no live request can still be reading them
+STALE_CHECKOUT_SECONDS = 15 * 60
+_CLEANUP_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cleanup")
+
+
+def _sweep_stale_checkouts() -> None:
     """
-    Fetch code from a repository at a specific commit.
+    Queue removal of checkouts left in the temp directory by earlier processes.
+    
+    The temp directory can be shared with other instances, so a checkout is
+    only removed once it is older than STALE_CHECKOUT_SECONDS.
+    """
+    temp_root = tempfile.gettempdir()
+    cutoff = time.time() - STALE_CHECKOUT_SECONDS
+    try:
+        with os.scandir(temp_root) as it:
+            stale = [entry.path for entry in it
+                     if entry.name.startswith(TEMP_DIR_PREFIX) and entry.is_dir(follow_symlinks=False)
+                     and entry.stat(follow_symlinks=False).st_mtime < cutoff]
+    except OSError as e:
+        logger.warning(f"⚠️ Could not scan {temp_root} for stale checkouts: {e}")
+        return
+    for path in stale:
+        _CLEANUP_POOL.submit(shutil.rmtree, path, ignore_errors=True)
+
+
+_sweep_stale_checkouts()
+
+# Refs that name a commit directly: a full SHA-1 or SHA-256 object ID. Shorter
+# hex strings may be branch or tag names, and servers only fetch full IDs.
+_COMMIT_SHA_RE = re.compile(r"[0-9a-fA-F]{40}|[0-9a-fA-F]{64}")
+
+# Code files to analyze, as suffixes for str.endswith and as checkout pathspecs
+_CODE_EXTENSIONS = ('.py', '.js', '.ts', '.java', '.cpp', '.c', '.go', '.rs', '.php', '.rb', '.cs')
+_CODE_PATHSPECS = [f'*{ext}' for ext in _CODE_EXTENSIONS]
+
+# Common non-code directories skipped while scanning a checkout
+_IGNORED_DIRS = frozenset({'node_modules', '__pycache__', 'venv', 'env', 'dist', 'build'})
+
+
+def _scan_code_files(root: str):
+    """
+    Yield (relative_path, absolute_path, size) for code files under root.
+    
+    Uses os.scandir with an explicit stack: the entry type comes from the
+    directory listing itself, so no extra stat() is needed per entry, and
+    only one directory handle is open at a time. Hidden and common non-code
+    directories are skipped, and so are empty files and files larger than
+    MAX_CODE_FILE_BYTES, using one stat() per code file.
+    
+    Args:
+        root: Directory to scan
+    """
+    prefix_len = len(root.rstrip(os.sep)) + 1
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                name = entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if not name.startswith('.') and name not in _IGNORED_DIRS:
+                        stack.append(entry.path)
+                elif name.endswith(_CODE_EXTENSIONS):
+                    size = entry.stat(follow_symlinks=False).st_size
+                    if 0 < size <= MAX_CODE_FILE_BYTES:
+                        yield entry.path[prefix_len:], entry.path, size
+
+
+def _read_one(paths) -> Optional[tuple]:
+    """
+    Read one code file, giving up early on binary files.
+    
+    The first BINARY_SNIFF_BYTES are read on their own; if they contain a
+    NUL byte the rest of the file is never read. Files over MMAP_MIN_BYTES
+    are memory-mapped and decoded from the page cache, skipping the copy
+    into an intermediate bytes object.
+    
+    Args:
+        paths: (relative_path, absolute_path, size) as yielded by _scan_code_files
+        
+    Returns:
+        (relative_path, content), or None for binary or unreadable files
+    """
+    relative_path, file_path, size = paths
+    try:
+        with open(file_path, 'rb') as f:
+            if size > MMAP_MIN_BYTES:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if mm.find(b'\x00', 0, BINARY_SNIFF_BYTES) != -1:
+                        return None
+                    return relative_path, str(mm, 'utf-8', 'ignore')
+            head = f.read(BINARY_SNIFF_BYTES)
+            if b'\x00' in head:
+                return None
+            data = head + f.read()
+    except OSError as e:
+        logger.warning(f"⚠️ Could not read file {relative_path}: {e}")
+        return None
+    return relative_path, data.decode('utf-8', errors='ignore')
+
+
+def _reads_worktree(repo_path: str, ref: str) -> bool:
+    """
+    Whether repo_path is scanned in place instead of exported at a commit.
+    
+    That is the case for a local directory at HEAD, where the working tree is
+    what is being analyzed, and for a local directory that is not a git
+    repository at all.
+    """
+    if repo_path.startswith(('http://', 'https://', 'git@')):
+        return False
+    return ref == 'HEAD' or pygit2.discover_repository(repo_path) is None
+
+
+def _export_commit(repo_path: str, ref: str, dest: str) -> None:
+    """
+    Write the code files of a repository at a commit into dest.
+    
+    Uses libgit2 in process instead of spawning git. Remote repositories are
+    fetched into a bare repository under dest/.git with depth 1: HEAD by a
+    shallow clone, a commit hash or branch by fetching just that ref. Local
+    repositories are opened where they are; they only come here for a pinned
+    commit (see _reads_worktree). Only files with a _CODE_EXTENSIONS suffix are
+    checked out, and the source repository's index is left untouched.
+    
+    Args:
+        repo_path: Repository URL or local path
+        ref: Commit hash, branch name or 'HEAD'
+        dest: Existing directory to write the files to
+        
+    Raises:
+        pygit2.GitError: If fetching fails or ref does not name a commit
+    """
+    if repo_path.startswith(('http://', 'https://', 'git@')):
+        git_dir = os.path.join(dest, '.git')
+        if ref == 'HEAD':
+            repo = pygit2.clone_repository(repo_path, git_dir, bare=True, depth=1)
+        else:
+            repo = pygit2.init_repository(git_dir, bare=True)
+            remote = repo.remotes.create('origin', repo_path)
+            if _COMMIT_SHA_RE.fullmatch(ref):
+                remote.fetch([ref], depth=1)
+            else:
+                remote.fetch([f'+refs/heads/{ref}:refs/remotes/origin/{ref}'], depth=1)
+                ref = f'refs/remotes/origin/{ref}'
+    else:
+        repo = pygit2.Repository(repo_path)
+    
+    try:
+        commit = repo.revparse_single(ref).peel(pygit2.Commit)
+    except (KeyError, ValueError) as e:
+        raise pygit2.GitError(f"Unknown revision '{ref}'") from e
+    
+    repo.checkout_tree(
+        commit,
+        directory=dest,
+        paths=_CODE_PATHSPECS,
+        strategy=pygit2.GIT_CHECKOUT_FORCE | pygit2.GIT_CHECKOUT_DONT_UPDATE_INDEX
+    )
+
+
+def iter_code_from_repo(repo_path: str, commit_hash: str) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the code files of a repository at a specific commit.
+    
+    This generator:
+    1. Exports the code files at the commit to a temporary directory
+       (see _export_commit); a local working tree at HEAD, or a local
+       directory that is not a git repository, is scanned in place instead
+    2. Reads the contents of relevant code files
+    3. Yields (file_path, content) pairs as they are read, so the caller
+       can consume them without holding a second copy of the repository
     
-    This function:
-    1. Clones the repository to a temporary directory
-    2. Checks out the specific commit hash
-    3. Reads the contents of relevant code files
-    4. Returns a dictionary mapping file paths to their contents
+    The temporary directory is removed once the generator is exhausted or
+    closed. Every path is absolute and no process-wide state such as the
+    working directory is changed, so concurrent requests on one instance
+    can fetch at the same time.
     
     Args:
         repo_path: Repository URL or local path
         commit_hash: Git commit hash to analyze
         
-    Returns:
-        Dict mapping file paths to their contents
+    Yields:
+        (file_path, content) for each non-empty code file
+        
+    Raises:
+        pygit2.GitError: If a git operation fails
     """
     logger.info(f"📥 Fetching code for repo '{repo_path}' at commit '{commit_hash}'...")
     
-    code_files = {}
+    file_count = 0
     temp_dir = None
     
     try:
-        # Create temporary directory
-        temp_dir = tempfile.mkdtemp()
-        
-        # Clone repository
-        if repo_path.startswith(('http://', 'https://', 'git@')):
-            # Remote repository
-            subprocess.run([
-                'git', 'clone', '--depth', '1', repo_path, temp_dir
-            ], check=True, capture_output=True, text=True)
+        ref = commit_hash or 'HEAD'
+        if _reads_worktree(repo_path, ref):
+            root = repo_path
         else:
-            # Local repository - copy to temp directory
-            shutil.copytree(repo_path, temp_dir, dirs_exist_ok=True)
-        
-        # Change to repository directory
-        os.chdir(temp_dir)
-        
-        # Checkout specific commit if not HEAD
-        if commit_hash and commit_hash != 'HEAD':
-            subprocess.run([
-                'git', 'checkout', commit_hash
-            ], check=True, capture_output=True, text=True)
+            # Create temporary directory
+            root = temp_dir = tempfile.mkdtemp(prefix=TEMP_DIR_PREFIX)
+            
+            # Only the code files at the requested commit are written
+            _export_commit(repo_path, ref, temp_dir)
         
         # Find and read code files
-        code_extensions = {'.py', '.js', '.ts', '.java', '.cpp', '.c', '.go', '.rs', '.php', '.rb', '.cs'}
+        paths = list(_scan_code_files(root))
         
-        for root, dirs, files in os.walk(temp_dir):
-            # Skip hidden directories and common non-code directories
-            dirs[:] = [d for d in dirs if not d.startswith('.') and d not in {'node_modules', '__pycache__', 'venv', 'env', 'dist', 'build'}]
-            
-            for file in files:
-                if any(file.endswith(ext) for ext in code_extensions):
-                    file_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(file_path, temp_dir)
-                    
-                    try:
-                        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                            content = f.read()
-                            if content.strip():  # Only include non-empty files
-                                code_files[relative_path] = content
-                    except Exception as e:
-                        logger.warning(f"⚠️ Could not read file {relative_path}: {e}")
+        # Reads overlap in a thread pool (the GIL is released while reading);
+        # map keeps the scan order so the prompt is the same on every run
+        if paths:
+            with ThreadPoolExecutor(max_workers=min(MAX_READ_WORKERS, len(paths))) as pool:
+                for result in pool.map(_read_one, paths):
+                    if result:
+                        file_count += 1
+                        yield result
         
-        logger.info(f"✅ Successfully fetched {len(code_files)} code files")
-        return code_files
+        logger.info(f"✅ Successfully fetched {file_count} code files")
         
-    except subprocess.CalledProcessError as e:
-        logger.error(f"❌ Git operation failed: {e}")
-        return {"error": f"Git operation failed: {e.stderr}"}
-    except Exception as e:
-        logger.error(f"❌ Failed to fetch code: {e}")
-        return {"error": str(e)}
     finally:
-        # Cleanup temporary directory
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
+        # Cleanup temporary directory in the background, off the response path
+        if temp_dir:
+            _CLEANUP_POOL.submit(shutil.rmtree, temp_dir, ignore_errors=True)
 
 
-def create_comprehensive_prompt(code_files: Dict[str, str]) -> str:
+def fetch_code_from_repo(repo_path: str, commit_hash: str) -> Dict[str, str]:
     """
-    Create a comprehensive analysis prompt for multiple files.
+    Fetch code from a repository at a specific commit.
     
     Args:
-        code_files: Dictionary mapping file paths to their contents
+        repo_path: Repository URL or local path
+        commit_hash: Git commit hash to analyze
         
     Returns:
-        Formatted prompt string
+        Dict mapping file paths to their contents, or {"error": ...}
     """
-    files_content = ""
-    for file_path, content in code_files.items():
-        files_content += f"\n--- FILE: {file_path} ---\n{content}\n"
-    
-    return f"""
+    try:
+        return dict(iter_code_from_repo(repo_path, commit_hash))
+    except pygit2.GitError as e:
+        logger.error(f"❌ Git operation failed: {e}")
+        return {"error": f"Git operation failed: {e}"}
+    except Exception as e:
+        logger.error(f"❌ Failed to fetch code: {e}")
+        return {"error": str(e)}
+
+
+# Prompt text before and after the file count in the JSON schema; the files
+# themselves follow _PROMPT_SCHEMA_REST
+_PROMPT_HEAD = """
     Please analyze the following codebase for security, quality, and performance issues.
     Return your findings as a valid JSON object with this structure:
     
-    {{
-        "repository_analysis": {{
+    {
+        "repository_analysis": {
             "overall_score": <number 0-100>,
-            "total_files": {len(code_files)},
+            "total_files": """
+_PROMPT_SCHEMA_REST = """,
             "risk_level": "<low|medium|high|critical>",
             "deployment_ready": <boolean>
-        }},
+        },
         "issues": [
-            {{
+            {
                 "type": "<security|quality|performance>",
                 "severity": "<critical|high|medium|low>",
                 "file": "<file_path>",
@@ -165,22 +464,22 @@ def create_comprehensive_prompt(code_files: Dict[str, str]) -> str:
                 "rule": "<rule_id>",
                 "suggestion": "<fix_suggestion>",
                 "confidence": <0.0-1.0>
-            }}
+            }
         ],
-        "file_metrics": {{
-            "<file_path>": {{
+        "file_metrics": {
+            "<file_path>": {
                 "quality_score": <0-100>,
                 "complexity": <number>,
                 "maintainability": <number>,
                 "security_score": <0-100>
-            }}
-        }},
+            }
+        },
         "recommendations": [
             "<recommendation_1>",
             "<recommendation_2>"
         ],
         "summary": "<overall_analysis_summary>"
-    }}
+    }
 
     Focus on:
     1. Security vulnerabilities (SQL injection, XSS, hardcoded secrets, etc.)
@@ -190,10 +489,94 @@ def create_comprehensive_prompt(code_files: Dict[str, str]) -> str:
     5. Testing and documentation gaps
 
     Codebase to analyze:
-    {files_content}
     """
 
 
+def create_comprehensive_prompt(code_files: Iterable[Tuple[str, str]]) -> Tuple[str, int]:
+    """
+    Create a comprehensive analysis prompt for multiple files.
+    
+    Files are consumed one at a time and the prompt is joined once at the
+    end; the file count in the JSON schema is filled in after the loop.
+    Prompt size drives inference latency and cost, so each file is cut to
+    MAX_PROMPT_FILE_CHARS and files that no longer fit in MAX_PROMPT_CHARS
+    are skipped, while later, smaller files can still use the rest of it.
+    
+    Args:
+        code_files: (file_path, content) pairs, e.g. from iter_code_from_repo
+            or dict.items()
+        
+    Returns:
+        Tuple of the formatted prompt string and the number of files in it
+    """
+    parts = [_PROMPT_HEAD, None, _PROMPT_SCHEMA_REST]
+    file_count = 0
+    skipped = 0
+    budget = MAX_PROMPT_CHARS
+    for file_path, content in code_files:
+        if len(content) > MAX_PROMPT_FILE_CHARS:
+            content = content[:MAX_PROMPT_FILE_CHARS] + "\n...[truncated]"
+        part = f"\n--- FILE: {file_path} ---\n{content}\n"
+        if len(part) > budget:
+            skipped += 1
+            continue
+        budget -= len(part)
+        parts.append(part)
+        file_count += 1
+    if skipped:
+        logger.warning(f"⚠️ Prompt budget of {MAX_PROMPT_CHARS} characters reached; skipped {skipped} files")
+    parts[1] = str(file_count)
+    parts.append("\n    ")
+    
+    return "".join(parts), file_count
+
+
+def _extract_json_object(text: str) -> str:
+    """
+    Slice the JSON object out of a model response.
+    
+    Markdown fences or prose around the object are dropped by slicing from
+    the first '{' to the last '}', instead of rescanning the whole response
+    once per fence marker. Text without an object is returned stripped.
+    """
+    start = text.find('{')
+    end = text.rfind('}')
+    if 0 <= start < end:
+        return text[start:end + 1]
+    return text.strip()
+
+
+# Prompts for immutable commits are kept per instance, so retries and
+# duplicate webhooks for the same commit skip the clone and file reads
+PROMPT_CACHE_SIZE = 8
+
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _build_prompt_cached(repo_path: str, commit_hash: str) -> Tuple[str, int]:
+    """create_comprehensive_prompt over iter_code_from_repo, memoized; failures are not cached."""
+    return create_comprehensive_prompt(iter_code_from_repo(repo_path, commit_hash))
+
+
+def build_repo_prompt(repo_path: str, commit_hash: str) -> Tuple[str, int]:
+    """
+    Build the analysis prompt for a repository at a commit.
+    
+    Full commit hashes name immutable snapshots, so their prompts are served
+    from an LRU cache; branch names, abbreviated hashes and HEAD can move and
+    are always fetched, and so is anything read from a working tree.
+    
+    Args:
+        repo_path: Repository URL or local path
+        commit_hash: Git commit hash or ref to analyze
+        
+    Returns:
+        Tuple of the prompt and the number of files in it
+    """
+    if commit_hash and _COMMIT_SHA_RE.fullmatch(commit_hash) and not _reads_worktree(repo_path, commit_hash):
+        return _build_prompt_cached(repo_path, commit_hash)
+    return create_comprehensive_prompt(iter_code_from_repo(repo_path, commit_hash))
+
+
 @functions_framework.http
 def analyze_code(request):
     """
@@ -205,8 +588,13 @@ def analyze_code(request):
         "commitHash": "abc123def456",
         "analysisType": "comprehensive"
     }
+    
+    ``?warmup=1`` is answered by warmup() so a scheduler can keep instances warm.
     """
-    if not vertex_endpoint or not publisher:
+    if request.args.get("warmup") == "1":
+        return warmup(request)
+    
+    if not vertex_endpoint:
         return ("Internal Server Error: Clients not initialized", 500)
 
     # Parse request
@@ -221,18 +609,19 @@ def analyze_code(request):
     logger.info(f"🔍 Starting {analysis_type} analysis for {repo_path} at {commit_hash}")
 
     try:
-        # --- CORE LOGIC: Fetch the actual code first ---
-        code_files = fetch_code_from_repo(repo_path, commit_hash)
-        
-        if "error" in code_files:
-            return (f"Error fetching code: {code_files['error']}", 400)
+        # --- CORE LOGIC: Fetch the code and build the prompt in one pass ---
+        try:
+            prompt, file_count = build_repo_prompt(repo_path, commit_hash)
+        except pygit2.GitError as e:
+            logger.error(f"❌ Git operation failed: {e}")
+            return (f"Error fetching code: Git operation failed: {e}", 400)
+        except OSError as e:
+            logger.error(f"❌ Failed to fetch code: {e}")
+            return (f"Error fetching code: {e}", 400)
         
-        if not code_files:
+        if not file_count:
             return ("No code files found in repository", 400)
 
-        # --- CORE LOGIC: Create comprehensive analysis prompt ---
-        prompt = create_comprehensive_prompt(code_files)
-
         logger.info("🤖 Sending analysis request to Vertex AI...")
         
         # Define the instance payload for the prediction request
@@ -244,14 +633,16 @@ def analyze_code(request):
             "topK": 40
         }
         
-        prediction = vertex_endpoint.predict(instances=instance, parameters=parameters)
+        prediction = prediction_client.predict(
+            endpoint=vertex_endpoint, instances=instance, parameters=parameters
+        )
         
         # --- CORE LOGIC: Parse the model's response ---
         response_text = prediction.predictions[0]['content']
-        clean_response = response_text.strip().replace("```json", "").replace("```", "").strip()
+        clean_response = _extract_json_object(response_text)
         
         try:
-            analysis_result = json.loads(clean_response)
+            analysis_result = _json_loads(clean_response)
         except json.JSONDecodeError as e:
             logger.error(f"❌ JSON parsing failed: {e}")
             logger.error(f"Raw response: {response_text}")
@@ -260,7 +651,7 @@ def analyze_code(request):
             analysis_result = {
                 "repository_analysis": {
                     "overall_score": 75,
-                    "total_files": len(code_files),
+                    "total_files": file_count,
                     "risk_level": "medium",
                     "deployment_ready": True
                 },
@@ -285,30 +676,35 @@ def analyze_code(request):
             }
 
         # Add metadata
+        correlation_id = uuid.uuid4().hex
         analysis_result["metadata"] = {
+            "correlation_id": correlation_id,
             "repo_path": repo_path,
             "commit_hash": commit_hash,
             "analysis_type": analysis_type,
-            "timestamp": "2025-01-27T10:30:00Z",
-            "files_analyzed": len(code_files),
+            "timestamp": _now(),
+            "files_analyzed": file_count,
             "ai_model": "vertex-ai-endpoint"
         }
 
         logger.info(f"✅ Analysis completed. Found {len(analysis_result.get('issues', []))} issues.")
 
         # --- BEST PRACTICE: Publish results to Pub/Sub ---
+        # The response doesn't wait for the ack; the correlation ID in the
+        # metadata and message attributes ties the message to this response
         if analysis_result.get('issues'):
-            message_data = json.dumps(analysis_result).encode("utf-8")
-            future = publisher.publish(topic_path, data=message_data)
-            message_id = future.result()
-            logger.info(f"📤 Published analysis results with message ID: {message_id}")
+            message_data, encoding_attributes = _encode_payload(_json_dumps(analysis_result))
+            _publish_in_background(
+                topic_path, message_data, correlation_id=correlation_id, **encoding_attributes
+            )
 
         return {
             "status": "success", 
             "issues": analysis_result.get('issues', []),
             "metadata": analysis_result.get('metadata'),
             "repository_analysis": analysis_result.get('repository_analysis'),
-            "message_id": message_id if 'message_id' in locals() else None
+            "message_id": None,
+            "correlation_id": correlation_id
         }
 
     except Exception as e:
@@ -316,6 +712,22 @@ def analyze_code(request):
         return (f"Internal Server Error: {str(e)}", 500)
 
 
+@functions_framework.http
+def warmup(request):
+    """
+    Lightweight warmup endpoint.
+    
+    Importing this module already starts initializing the clients, so a ping
+    is enough to keep an instance warm; it also waits for the Pub/Sub client
+    and makes sure its channel is connected before real traffic arrives.
+    """
+    try:
+        _warm_channel(get_publisher())
+    except Exception as e:
+        logger.error(f"❌ Error initializing Pub/Sub client: {e}")
+    return {"status": "warm", "clients_initialized": _publisher is not None}, 200
+
+
 @functions_framework.http
 def health_check(request):
     """Health check endpoint for the Cloud Function."""
@@ -324,11 +736,11 @@ def health_check(request):
         status = {
             "status": "healthy",
             "vertex_ai": vertex_endpoint is not None,
-            "pubsub": publisher is not None,
+            "pubsub": _publisher is not None,
             "project_id": PROJECT_ID,
             "region": REGION,
             "endpoint_id": ENDPOINT_ID,
-            "timestamp": "2025-01-27T10:30:00Z",
+            "timestamp": _now(),
             "service_version": "2.1.0"
         }
         
@@ -337,237 +749,441 @@ def health_check(request):
         return {"status": "unhealthy", "error": str(e)}, 500
 
 
-@functions_framework.cloud_event
-def doc_agent(cloud_event):
-    """
-    Processes Pub/Sub messages containing issues and publishes documentation updates.
-    This function is triggered by Pub/Sub messages from the code analysis results.
+def _log_publish_error(topic: str):
+    """Return a done callback that logs a failed background publish to topic."""
+    def callback(future) -> None:
+        exception = future.exception()
+        if exception is not None:
+            logger.error(f"❌ Error publishing to Pub/Sub topic {topic}: {exception}")
+    return callback
+
+
+# Background publishes not yet acknowledged; the semaphore bounds how many
+# there can be and the set lets them be flushed when the instance shuts down
+_inflight_publishes = threading.BoundedSemaphore(MAX_INFLIGHT_PUBLISHES)
+_pending_publishes = set()
+_pending_publishes_lock = threading.Lock()
+
+
+def _publish_in_background(topic: str, data: bytes, **attributes: str) -> None:
     """
-    logger.info(f"📚 Doc Agent received event: {cloud_event}")
+    Publish a message without waiting for its acknowledgement.
     
+    The outcome is logged by a done callback. Blocks only while
+    MAX_INFLIGHT_PUBLISHES messages are still unacknowledged.
+    """
+    _inflight_publishes.acquire()
     try:
-        # Decode the Pub/Sub message data
-        if hasattr(cloud_event, 'data') and cloud_event.data:
-            # For Cloud Events, data is already decoded
-            message_data = cloud_event.data
-            
-            if isinstance(message_data, bytes):
-                message_str = message_data.decode('utf-8')
-            else:
-                message_str = str(message_data)
-                
-            logger.info(f"📝 Decoded message: {message_str[:200]}...")  # Log first 200 chars
-            
+        future = get_publisher().publish(topic, data=data, **attributes)
+    except Exception:
+        _inflight_publishes.release()
+        raise
+    with _pending_publishes_lock:
+        _pending_publishes.add(future)
+    
+    def callback(f) -> None:
+        with _pending_publishes_lock:
+            _pending_publishes.discard(f)
+        _inflight_publishes.release()
+        exception = f.exception()
+        if exception is not None:
+            logger.error(f"❌ Error publishing to Pub/Sub topic {topic} ({attributes}): {exception}")
         else:
-            logger.error("❌ No data found in cloud event.")
-            return {"status": "error", "message": "No data in Pub/Sub message"}
+            logger.info(f"📤 Published to {topic} with message ID {f.result()} ({attributes})")
+    
+    future.add_done_callback(callback)
 
-        try:
-            analysis_result = json.loads(message_str)
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ Error decoding JSON from message: {e}")
-            return {"status": "error", "message": "Invalid JSON format in message"}
 
-        # Process issues and generate documentation
-        issues = analysis_result.get('issues', [])
-        metadata = analysis_result.get('metadata', {})
-        
-        # Generate documentation update based on analysis results
-        doc_update = {
-            "agent": "documentation",
-            "timestamp": "2025-01-27T10:30:00Z",
-            "repo_path": metadata.get('repo_path', 'unknown'),
-            "action": "documentation_generated",
-            "summary": f"Generated documentation for {len(issues)} issues across {metadata.get('files_analyzed', 0)} files",
-            "details": {
-                "security_docs": len([i for i in issues if i.get('type') == 'security']),
-                "quality_docs": len([i for i in issues if i.get('type') == 'quality']),
-                "performance_docs": len([i for i in issues if i.get('type') == 'performance']),
-                "recommendations": analysis_result.get('recommendations', [])
-            }
-        }
-        
-        logger.info(f"📖 Doc update: {doc_update['summary']}")
+@atexit.register
+def _flush_pending_publishes() -> None:
+    """Wait for unacknowledged background publishes before the process exits."""
+    with _pending_publishes_lock:
+        pending = list(_pending_publishes)
+    if pending:
+        _, not_done = wait(pending, timeout=PUBLISH_FLUSH_TIMEOUT)
+        if not_done:
+            logger.error(f"❌ {len(not_done)} Pub/Sub messages still unacknowledged at shutdown")
 
-        # Publish update to doc-agent-messages topic
-        if not PROJECT_ID:
-            logger.error("❌ Error: GCP_PROJECT environment variable not set.")
-            return {"status": "error", "message": "Project ID not configured"}
 
-        try:
-            doc_message_data = json.dumps(doc_update).encode('utf-8')
-            future = publisher.publish(doc_topic_path, data=doc_message_data)
-            future.result()  # Wait for the publish to complete
-            logger.info(f"📤 Published documentation update to {doc_topic_path}")
-        except Exception as e:
-            logger.error(f"❌ Error publishing to Pub/Sub topic {doc_topic_path}: {e}")
-            return {"status": "error", "message": f"Failed to publish to {doc_topic_path}"}
+def _tally(issues: List[Dict[str, Any]]) -> Tuple[Counter, Counter]:
+    """
+    Count issues per type and per severity in a single pass.
+    
+    Returns:
+        Tuple of (type counts, severity counts); missing keys count as 0
+    """
+    type_counts = Counter()
+    severity_counts = Counter()
+    for issue in issues:
+        type_counts[issue.get('type')] += 1
+        severity_counts[issue.get('severity')] += 1
+    return type_counts, severity_counts
 
-        return {"status": "success", "message": doc_update['summary'], "details": doc_update}
 
-    except Exception as e:
-        logger.error(f"❌ Doc Agent processing failed: {str(e)}")
-        return {"status": "error", "message": f"Doc Agent processing failed: {str(e)}"}
+class PayloadTooLargeError(ValueError):
+    """Raised when a Pub/Sub payload exceeds MAX_MESSAGE_BYTES."""
 
 
-@functions_framework.cloud_event  
-def test_agent(cloud_event):
+class InvalidPayloadError(ValueError):
+    """Raised when a compressed Pub/Sub payload is corrupt or truncated."""
+
+
+# zstd (de)compressors are not safe to share between threads; one per thread
+_zstd_local = threading.local()
+
+
+def _encode_payload(data: bytes) -> Tuple[bytes, Dict[str, str]]:
+    """
+    Compress a JSON payload for Pub/Sub according to PUBSUB_COMPRESSION.
+    
+    Analysis results repeat the same keys and paths many times, so zstd
+    shrinks them several-fold.
+    
+    Returns:
+        Tuple of the payload and the message attributes describing it
+        (``content_encoding="zstd"`` when compressed)
     """
-    Processes Pub/Sub messages and generates test recommendations.
-    This function is triggered by Pub/Sub messages from the code analysis results.
+    if PUBSUB_COMPRESSION != "zstd" or zstandard is None:
+        return data, {}
+    compressor = getattr(_zstd_local, "compressor", None)
+    if compressor is None:
+        compressor = _zstd_local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return compressor.compress(data), {"content_encoding": "zstd"}
+
+
+def _decompress_payload(payload: bytes) -> bytes:
     """
-    logger.info(f"🧪 Test Agent received event: {cloud_event}")
+    Decompress a zstd payload, refusing output larger than MAX_MESSAGE_BYTES.
     
+    Raises:
+        PayloadTooLargeError: If the payload would decompress to more than
+            MAX_MESSAGE_BYTES
+        InvalidPayloadError: If the payload is not a valid zstd frame
+        ValueError: If zstandard is not installed
+    """
+    if zstandard is None:
+        raise ValueError("Message is zstd-compressed but zstandard is not installed")
+    decompressor = getattr(_zstd_local, "decompressor", None)
+    if decompressor is None:
+        decompressor = _zstd_local.decompressor = zstandard.ZstdDecompressor()
     try:
-        # Decode the Pub/Sub message data
-        if hasattr(cloud_event, 'data') and cloud_event.data:
-            if isinstance(cloud_event.data, bytes):
-                message_str = cloud_event.data.decode('utf-8')
-            else:
-                message_str = str(cloud_event.data)
-                
-            logger.info(f"🔬 Processing test generation for analysis results...")
-            
-        else:
-            logger.error("❌ No data found in cloud event.")
-            return {"status": "error", "message": "No data in Pub/Sub message"}
-
+        if zstandard.frame_content_size(payload) > MAX_MESSAGE_BYTES:
+            raise PayloadTooLargeError(f"Payload exceeds {MAX_MESSAGE_BYTES} bytes")
+        return decompressor.decompress(payload, max_output_size=MAX_MESSAGE_BYTES)
+    except zstandard.ZstdError as e:
+        # Without a size in the frame header, overflowing max_output_size and
+        # a broken frame raise the same error; decompressing one byte past
+        # the limit tells them apart
         try:
-            analysis_result = json.loads(message_str)
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ Error decoding JSON from message: {e}")
-            return {"status": "error", "message": "Invalid JSON format in message"}
+            with decompressor.stream_reader(payload) as reader:
+                too_large = len(reader.read(MAX_MESSAGE_BYTES + 1)) > MAX_MESSAGE_BYTES
+        except zstandard.ZstdError:
+            too_large = False
+        if too_large:
+            raise PayloadTooLargeError(f"Payload exceeds {MAX_MESSAGE_BYTES} bytes") from e
+        raise InvalidPayloadError(f"Invalid compressed payload: {e}") from e
 
-        # Process issues and generate test recommendations
-        issues = analysis_result.get('issues', [])
-        metadata = analysis_result.get('metadata', {})
-        
-        # Generate test recommendations based on analysis results
-        test_update = {
-            "agent": "test_generator",
-            "timestamp": "2025-01-27T10:30:00Z",
-            "repo_path": metadata.get('repo_path', 'unknown'),
-            "action": "tests_generated",
-            "summary": f"Generated test recommendations for {len(issues)} issues",
-            "details": {
-                "security_tests": len([i for i in issues if i.get('type') == 'security']),
-                "unit_tests": len([i for i in issues if i.get('type') == 'quality']),
-                "performance_tests": len([i for i in issues if i.get('type') == 'performance']),
-                "test_coverage_recommendations": [
-                    "Add unit tests for authentication functions",
-                    "Implement integration tests for API endpoints", 
-                    "Create security tests for input validation",
-                    "Add performance tests for database queries"
-                ]
-            }
-        }
-        
-        logger.info(f"🧪 Test update: {test_update['summary']}")
 
-        # Publish update to test-agent-messages topic
-        test_topic_path = publisher.topic_path(PROJECT_ID, "test-agent-messages")
+def _decode_message_data(cloud_event) -> Optional[bytes]:
+    """
+    Return the payload of a Pub/Sub CloudEvent as raw bytes.
+    
+    Pub/Sub delivers ``{"message": {"data": "<base64>"}}``; raw bytes or
+    string payloads (e.g. from local testing) are accepted as they are.
+    Messages with a ``content_encoding="zstd"`` attribute are decompressed.
+    The bytes are left undecoded since the JSON parser reads them directly.
+    
+    Returns:
+        The decoded message, or None if the event carries no data
         
-        try:
-            test_message_data = json.dumps(test_update).encode('utf-8')
-            future = publisher.publish(test_topic_path, data=test_message_data)
-            future.result()
-            logger.info(f"📤 Published test update to {test_topic_path}")
-        except Exception as e:
-            logger.error(f"❌ Error publishing to test topic: {e}")
-            return {"status": "error", "message": f"Failed to publish test update"}
+    Raises:
+        PayloadTooLargeError: If the payload would decode to more than
+            MAX_MESSAGE_BYTES; base64 input is checked before decoding
+            and zstd input before decompressing
+        InvalidPayloadError: If zstd input is corrupt or truncated
+    """
+    data = getattr(cloud_event, 'data', None)
+    if not data:
+        return None
+    if isinstance(data, dict):
+        message = data.get('message', {})
+        encoded = message.get('data')
+        if not encoded:
+            return None
+        # base64 expands by 4/3, so the encoded length bounds the decoded size
+        if len(encoded) > MAX_MESSAGE_BYTES * 4 // 3 + 4:
+            raise PayloadTooLargeError(f"Payload exceeds {MAX_MESSAGE_BYTES} bytes")
+        payload = _b64decode(encoded)
+        if (message.get('attributes') or {}).get('content_encoding') == 'zstd':
+            payload = _decompress_payload(payload)
+        return payload
+    payload = data if isinstance(data, bytes) else str(data).encode('utf-8')
+    if len(payload) > MAX_MESSAGE_BYTES:
+        raise PayloadTooLargeError(f"Payload exceeds {MAX_MESSAGE_BYTES} bytes")
+    return payload
 
-        return {"status": "success", "message": test_update['summary'], "details": test_update}
 
-    except Exception as e:
-        logger.error(f"❌ Test Agent processing failed: {str(e)}")
-        return {"status": "error", "message": f"Test Agent processing failed: {str(e)}"}
+# Topics the agents publish their updates to
+_TEST_TOPIC = _topic_path("test-agent-messages")
+_QA_TOPIC = _topic_path("qa-agent-messages")
 
 
-@functions_framework.cloud_event
-def qa_agent(cloud_event):
+def _message_attributes(cloud_event) -> Dict[str, str]:
+    """Attributes of the Pub/Sub message carried by the event, or {}."""
+    data = getattr(cloud_event, 'data', None)
+    return (data.get('message', {}).get('attributes') or {}) if isinstance(data, dict) else {}
+
+
+def _is_partial_result(cloud_event) -> bool:
+    """
+    Whether the event carries a per-chunk partial analysis.
+    
+    cloud_function_analyzer.py can publish each chunk's findings with
+    partial="true" before the merged result; the agents only act on the
+    final one.
     """
-    Processes Pub/Sub messages and performs QA analysis.
-    This function is triggered by Pub/Sub messages from the code analysis results.
+    return _message_attributes(cloud_event).get('partial') == 'true'
+
+
+def _handle(cloud_event, agent_label: str, build_update, topic: str, after_publish=None) -> Dict[str, Any]:
+    """
+    Shared body of the Pub/Sub agents.
+    
+    Decodes and parses the analysis result carried by the event, builds the
+    agent's update from it and publishes the update without waiting for the
+    ack (failures are logged by a callback).
+    
+    Args:
+        cloud_event: The Pub/Sub CloudEvent
+        agent_label: Agent name used in logs and error messages
+        build_update: Called as build_update(analysis_result, issues, metadata);
+            returns the update dict, which must have a "summary"
+        topic: Full path of the topic the update is published to
+        after_publish: Optional callable(publisher, update, issues) for extra
+            messages; raising makes the invocation fail
+        
+    Returns:
+        Status dict with the update as "details"
     """
-    logger.info(f"✅ QA Agent received event: {cloud_event}")
+    # Per-event logs are debug-only and lazily formatted to keep the hot path cheap
+    logger.debug("📨 %s received event: %s", agent_label, cloud_event)
+    
+    if _is_partial_result(cloud_event):
+        logger.debug("⏭️ %s skipped a partial analysis result", agent_label)
+        return {"status": "skipped", "message": "Partial analysis result"}
     
     try:
         # Decode the Pub/Sub message data
-        if hasattr(cloud_event, 'data') and cloud_event.data:
-            if isinstance(cloud_event.data, bytes):
-                message_str = cloud_event.data.decode('utf-8')
-            else:
-                message_str = str(cloud_event.data)
-                
-            logger.info(f"🔍 Processing QA analysis for results...")
-            
+        try:
+            message_bytes = _decode_message_data(cloud_event)
+        except PayloadTooLargeError as e:
+            logger.error(f"❌ {e}")
+            return {"status": "error", "message": "Payload too large"}
+        except InvalidPayloadError as e:
+            logger.error(f"❌ {e}")
+            return {"status": "error", "message": "Invalid compressed payload"}
+        if message_bytes:
+            logger.debug("📝 Decoded message: %.200r...", message_bytes)  # Log first 200 chars
         else:
             logger.error("❌ No data found in cloud event.")
             return {"status": "error", "message": "No data in Pub/Sub message"}
 
         try:
-            analysis_result = json.loads(message_str)
+            analysis_result = _json_loads(message_bytes)
         except json.JSONDecodeError as e:
             logger.error(f"❌ Error decoding JSON from message: {e}")
             return {"status": "error", "message": "Invalid JSON format in message"}
 
-        # Process issues and perform QA analysis
         issues = analysis_result.get('issues', [])
         metadata = analysis_result.get('metadata', {})
-        repository_analysis = analysis_result.get('repository_analysis', {})
-        
-        # Calculate QA metrics
-        critical_issues = len([i for i in issues if i.get('severity') == 'critical'])
-        high_issues = len([i for i in issues if i.get('severity') == 'high'])
-        security_issues = len([i for i in issues if i.get('type') == 'security'])
-        
-        # Determine deployment readiness
-        deployment_ready = critical_issues == 0 and security_issues <= 2
-        risk_level = "low" if critical_issues == 0 else "high" if critical_issues > 2 else "medium"
-        
-        # Generate QA report
-        qa_update = {
-            "agent": "qa_analyzer",
-            "timestamp": "2025-01-27T10:30:00Z",
-            "repo_path": metadata.get('repo_path', 'unknown'),
-            "action": "qa_analysis_completed",
-            "summary": f"QA analysis completed: {risk_level} risk, {'ready' if deployment_ready else 'blocked'} for deployment",
-            "details": {
-                "deployment_ready": deployment_ready,
-                "risk_level": risk_level,
-                "quality_score": repository_analysis.get('overall_score', 75),
-                "critical_issues": critical_issues,
-                "high_issues": high_issues,
-                "security_issues": security_issues,
-                "quality_gates": {
-                    "no_critical_issues": critical_issues == 0,
-                    "security_threshold": security_issues <= 2,
-                    "quality_score_threshold": repository_analysis.get('overall_score', 75) >= 70
-                },
-                "recommendations": [
-                    f"Address {critical_issues} critical issues before deployment" if critical_issues > 0 else "No critical issues found",
-                    f"Review {security_issues} security issues" if security_issues > 0 else "Security posture is acceptable",
-                    "Consider implementing automated quality gates"
-                ]
-            }
-        }
+        update = build_update(analysis_result, issues, metadata)
         
-        logger.info(f"✅ QA update: {qa_update['summary']}")
+        logger.debug("📖 %s update: %s", agent_label, update['summary'])
 
-        # Publish update to qa-agent-messages topic
-        qa_topic_path = publisher.topic_path(PROJECT_ID, "qa-agent-messages")
-        
         try:
-            qa_message_data = json.dumps(qa_update).encode('utf-8')
-            future = publisher.publish(qa_topic_path, data=qa_message_data)
-            future.result()
-            logger.info(f"📤 Published QA update to {qa_topic_path}")
+            # Don't wait for the ack; failures are logged by the callback
+            publisher = get_publisher()
+            future = publisher.publish(topic, data=_json_dumps(update))
+            future.add_done_callback(_log_publish_error(topic))
+            logger.debug("📤 Queued %s update for %s", agent_label, topic)
+            
+            if after_publish is not None:
+                after_publish(publisher, update, issues)
         except Exception as e:
-            logger.error(f"❌ Error publishing to QA topic: {e}")
-            return {"status": "error", "message": f"Failed to publish QA update"}
+            logger.error(f"❌ Error publishing to Pub/Sub topic {topic}: {e}")
+            return {"status": "error", "message": f"Failed to publish to {topic}"}
 
-        return {"status": "success", "message": qa_update['summary'], "details": qa_update}
+        return {"status": "success", "message": update['summary'], "details": update}
 
     except Exception as e:
-        logger.error(f"❌ QA Agent processing failed: {str(e)}")
-        return {"status": "error", "message": f"QA Agent processing failed: {str(e)}"}
\ No newline at end of file
+        logger.error(f"❌ {agent_label} processing failed: {str(e)}")
+        return {"status": "error", "message": f"{agent_label} processing failed: {str(e)}"}
+
+
+def _build_doc_update(analysis_result: Dict[str, Any], issues: List[Dict[str, Any]],
+                      metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Documentation update for an analysis result."""
+    type_counts, _ = _tally(issues)
+    return {
+        "agent": "documentation",
+        "timestamp": _now(),
+        "repo_path": metadata.get('repo_path', 'unknown'),
+        "action": "documentation_generated",
+        "summary": _format_doc_summary(len(issues), metadata.get('files_analyzed', 0)),
+        "details": {
+            "security_docs": type_counts['security'],
+            "quality_docs": type_counts['quality'],
+            "performance_docs": type_counts['performance'],
+            "recommendations": analysis_result.get('recommendations', [])
+        }
+    }
+
+
+def _publish_doc_issue_updates(publisher, doc_update: Dict[str, Any], issues: List[Dict[str, Any]]) -> None:
+    """
+    Publish one documentation message per issue when DOC_AGENT_ISSUE_UPDATES is set.
+    
+    Every message is queued first so the client batches them, then all of
+    them are awaited once instead of once per message.
+    
+    Raises:
+        RuntimeError: If any message was not published within PUBLISH_FLUSH_TIMEOUT
+    """
+    if not DOC_AGENT_ISSUE_UPDATES:
+        return
+    futures = [
+        publisher.publish(doc_topic_path, data=_json_dumps({
+            "agent": "documentation",
+            "repo_path": doc_update["repo_path"],
+            "action": "issue_documented",
+            "issue": issue
+        }))
+        for issue in issues
+    ]
+    _, not_done = wait(futures, timeout=PUBLISH_FLUSH_TIMEOUT)
+    failed = len(not_done) + sum(1 for f in futures if f.done() and f.exception() is not None)
+    if failed:
+        raise RuntimeError(f"{failed} of {len(futures)} issue updates were not published")
+
+
+def _build_test_update(analysis_result: Dict[str, Any], issues: List[Dict[str, Any]],
+                       metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Test recommendations for an analysis result."""
+    type_counts, _ = _tally(issues)
+    return {
+        "agent": "test_generator",
+        "timestamp": _now(),
+        "repo_path": metadata.get('repo_path', 'unknown'),
+        "action": "tests_generated",
+        "summary": f"Generated test recommendations for {len(issues)} issues",
+        "details": {
+            "security_tests": type_counts['security'],
+            "unit_tests": type_counts['quality'],
+            "performance_tests": type_counts['performance'],
+            "test_coverage_recommendations": [
+                "Add unit tests for authentication functions",
+                "Implement integration tests for API endpoints", 
+                "Create security tests for input validation",
+                "Add performance tests for database queries"
+            ]
+        }
+    }
+
+
+def _build_qa_update(analysis_result: Dict[str, Any], issues: List[Dict[str, Any]],
+                     metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """QA report, with deployment readiness, for an analysis result."""
+    repository_analysis = analysis_result.get('repository_analysis', {})
+    
+    # Calculate QA metrics
+    type_counts, severity_counts = _tally(issues)
+    critical_issues = severity_counts['critical']
+    high_issues = severity_counts['high']
+    security_issues = type_counts['security']
+    
+    # Determine deployment readiness
+    deployment_ready = critical_issues == 0 and security_issues <= 2
+    risk_level = "low" if critical_issues == 0 else "high" if critical_issues > 2 else "medium"
+    
+    return {
+        "agent": "qa_analyzer",
+        "timestamp": _now(),
+        "repo_path": metadata.get('repo_path', 'unknown'),
+        "action": "qa_analysis_completed",
+        "summary": f"QA analysis completed: {risk_level} risk, {'ready' if deployment_ready else 'blocked'} for deployment",
+        "details": {
+            "deployment_ready": deployment_ready,
+            "risk_level": risk_level,
+            "quality_score": repository_analysis.get('overall_score', 75),
+            "critical_issues": critical_issues,
+            "high_issues": high_issues,
+            "security_issues": security_issues,
+            "quality_gates": {
+                "no_critical_issues": critical_issues == 0,
+                "security_threshold": security_issues <= 2,
+                "quality_score_threshold": repository_analysis.get('overall_score', 75) >= 70
+            },
+            "recommendations": [
+                f"Address {critical_issues} critical issues before deployment" if critical_issues > 0 else "No critical issues found",
+                f"Review {security_issues} security issues" if security_issues > 0 else "Security posture is acceptable",
+                "Consider implementing automated quality gates"
+            ]
+        }
+    }
+
+
+@functions_framework.cloud_event
+def doc_agent(cloud_event):
+    """Publishes documentation updates for analysis results received over Pub/Sub."""
+    return _handle(cloud_event, "Doc Agent", _build_doc_update, doc_topic_path, _publish_doc_issue_updates)
+
+
+@functions_framework.cloud_event
+def test_agent(cloud_event):
+    """Publishes test recommendations for analysis results received over Pub/Sub."""
+    return _handle(cloud_event, "Test Agent", _build_test_update, _TEST_TOPIC)
+
+
+@functions_framework.cloud_event
+def qa_agent(cloud_event):
+    """Publishes QA reports for analysis results received over Pub/Sub."""
+    return _handle(cloud_event, "QA Agent", _build_qa_update, _QA_TOPIC)
+
+
+# Agents run by agent_dispatch, keyed by the message's "agent" attribute
+_AGENTS = {
+    "doc": doc_agent,
+    "test": test_agent,
+    "qa": qa_agent
+}
+
+
+@functions_framework.cloud_event
+def agent_dispatch(cloud_event):
+    """
+    Single Pub/Sub entry point for the doc, test and QA agents.
+    
+    Deploying one function instead of three lets the agents share warm
+    instances and pay for imports once. A message with an ``agent``
+    attribute is handled by that agent only; messages without one (such as
+    the analysis results published by analyze_code) go to every agent.
+    Partial results (partial="true") are acknowledged without running any
+    agent.
+    """
+    if _is_partial_result(cloud_event):
+        logger.debug("⏭️ Skipped a partial analysis result")
+        return {"status": "skipped", "message": "Partial analysis result"}
+    
+    agent = _message_attributes(cloud_event).get('agent')
+    
+    if agent is None:
+        agent_names = list(_AGENTS)
+    elif agent in _AGENTS:
+        agent_names = [agent]
+    else:
+        logger.error(f"❌ Unknown agent '{agent}' in message attributes")
+        return {"status": "error", "message": f"Unknown agent: {agent}"}
+    
+    results = {name: _AGENTS[name](cloud_event) for name in agent_names}
+    status = "success" if all(r.get("status") == "success" for r in results.values()) else "error"
+    return {"status": status, "results": results}
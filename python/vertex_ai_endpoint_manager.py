@@ -1,34 +1,287 @@
-import os
-import json
+import ast
 import asyncio
-from typing import Dict, List, Any, Optional
-from google.cloud import aiplatform
-from google.cloud import pubsub_v1
+import copy
+import hashlib
+import json
 import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Optional, Tuple, TypedDict
+
+from orjson import loads as _json_loads  # orjson.JSONDecodeError subclasses json's
+
+if TYPE_CHECKING:
+    from google.cloud import aiplatform
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# gRPC channel options for prediction RPCs: keepalive pings keep the HTTP/2
+# connection open between batches instead of reconnecting on the next one
+PREDICT_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0)
+]
+
+# Endpoint objects shared by all managers, keyed by (project, region, endpoint ID)
+_ENDPOINTS: Dict[Tuple[str, str, str], "aiplatform.Endpoint"] = {}
+
+
+def _strip_code_fence(response_text: str) -> str:
+    """Remove a leading and a trailing Markdown code fence from a JSON response, each if present."""
+    text = response_text.strip()
+    if text.startswith("```"):
+        text = text[3:].removeprefix("json")
+    return text.removesuffix("```")
+
+# Instructions and response schema shared by every analysis prompt
+_PROMPT_HEAD = """
+        Please analyze the following code for security, quality, and performance issues.
+        Return your findings as a valid JSON object with this structure:
+        {
+            "file_path": "<file_path>",
+            "quality_score": <number 0-100>,
+            "issues": [
+                {
+                    "type": "<security|quality|performance>",
+                    "severity": "<critical|high|medium|low>",
+                    "line": <line_number>,
+                    "message": "<description>",
+                    "rule": "<rule_id>",
+                    "suggestion": "<fix_suggestion>",
+                    "confidence": <0.0-1.0>
+                }
+            ],
+            "metrics": {
+                "complexity": <number>,
+                "maintainability": <number>,
+                "test_coverage": <number>
+            },
+            "ai_insights": [
+                "<insight_1>",
+                "<insight_2>"
+            ]
+        }
+        
+"""
+
+# Focus list per file extension; files of other types get the generic one
+_DEFAULT_FOCUS = (
+    "Security vulnerabilities (SQL injection, XSS, etc.)",
+    "Code quality issues (complexity, maintainability)",
+    "Performance bottlenecks",
+    "Best practice violations"
+)
+_SCRIPT_FOCUS = (
+    "Security vulnerabilities (XSS, eval of untrusted input, prototype pollution)",
+    "Code quality issues (complexity, unhandled promise rejections)",
+    "Performance bottlenecks (blocking the event loop, needless re-renders)",
+    "Best practice violations"
+)
+_LANGUAGE_FOCUS = {
+    ".py": (
+        "Security vulnerabilities (SQL/command injection, unsafe deserialization)",
+        "Code quality issues (complexity, broad exception handling, missing type hints)",
+        "Performance bottlenecks (repeated work in loops, blocking I/O)",
+        "Best practice violations (PEP 8)"
+    ),
+    ".js": _SCRIPT_FOCUS,
+    ".jsx": _SCRIPT_FOCUS,
+    ".ts": _SCRIPT_FOCUS + ("Unsafe use of `any` and non-null assertions",),
+    ".tsx": _SCRIPT_FOCUS + ("Unsafe use of `any` and non-null assertions",),
+    ".sql": (
+        "Security vulnerabilities (dynamic SQL, excessive privileges)",
+        "Code quality issues (readability, implicit column lists)",
+        "Performance bottlenecks (full table scans, missing indexes, SELECT *)",
+        "Best practice violations"
+    ),
+    ".go": (
+        "Security vulnerabilities (command injection, unchecked input)",
+        "Code quality issues (ignored errors, complexity)",
+        "Performance bottlenecks (goroutine leaks, needless allocations)",
+        "Best practice violations (context propagation, idiomatic Go)"
+    )
+}
+
+
+def _build_prompt_prefix(focus: Tuple[str, ...]) -> str:
+    """Full static prompt text for one focus list, up to the file path."""
+    items = "".join(f"        {number}. {item}\n" for number, item in enumerate(focus, 1))
+    return f"{_PROMPT_HEAD}        Focus on:\n{items}\n        Code to analyze:\n        File: "
+
+
+# Static prompt prefixes, built once at import. Each is identical for every
+# file of its type so the serving side can reuse the cached prefix;
+# everything file-specific comes after it.
+_DEFAULT_PROMPT_PREFIX = _build_prompt_prefix(_DEFAULT_FOCUS)
+_PROMPT_PREFIXES = {ext: _build_prompt_prefix(focus) for ext, focus in _LANGUAGE_FOCUS.items()}
+
+
+def _split_code_for_analysis(code: str, max_chars: int = 8000) -> List[Tuple[str, int]]:
+    """
+    Split source code into chunks of at most max_chars for separate analysis.
+    
+    Python code is split between top-level statements (a function or class
+    stays whole when it fits); anything that does not parse, and statements
+    larger than the budget, are split between lines.
+    
+    Args:
+        code: The source code to split
+        max_chars: Character budget per chunk
+        
+    Returns:
+        (chunk_text, line_offset) pairs, line_offset being the number of
+        lines before the chunk in the original code
+    """
+    lines = code.split("\n")
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        starts = []
+    else:
+        # A decorated definition starts at its first decorator
+        starts = [
+            min([node.lineno, *(d.lineno for d in getattr(node, "decorator_list", ()))]) - 1
+            for node in tree.body
+        ]
+    bounds = sorted({0, len(lines), *starts})
+    sizes = [len(line) + 1 for line in lines]
+    
+    # Ranges that are never split: one statement, or one line of an oversized one
+    ranges = []
+    for start, end in zip(bounds, bounds[1:]):
+        if sum(sizes[start:end]) <= max_chars:
+            ranges.append((start, end))
+        else:
+            ranges.extend((i, i + 1) for i in range(start, end))
+    
+    chunks = []
+    chunk_start = chunk_size = 0
+    for start, end in ranges:
+        size = sum(sizes[start:end])
+        if chunk_size and chunk_size + size > max_chars:
+            chunks.append(("\n".join(lines[chunk_start:start]), chunk_start))
+            chunk_start, chunk_size = start, 0
+        chunk_size += size
+    chunks.append(("\n".join(lines[chunk_start:]), chunk_start))
+    return chunks
+
+
+class AnalysisResult(TypedDict, total=False):
+    """Analysis of one file; failed analyses carry only "error" and "file_path"."""
+    file_path: str
+    quality_score: float
+    issues: List[Dict[str, Any]]
+    metrics: Dict[str, float]
+    ai_insights: List[str]
+    raw_response: str
+    chunk_errors: List[str]
+    error: str
+
+
+def _mean(values: List[float]) -> float:
+    """Mean of the values rounded to one decimal, or 0 when there are none."""
+    return round(math.fsum(values) / len(values), 1) if values else 0
+
+
 class VertexAIEndpointManager:
     """
     Advanced Vertex AI Endpoint Manager for Code Analyzer Agent.
     Handles endpoint creation, deployment, and model predictions.
     """
     
-    def __init__(self, project_id: str = None, region: str = None):
+    MAX_BATCH_SIZE = 16
+    MAX_BATCH_TOKENS = 32000  # estimated as len(code) // 4
+    BATCH_WINDOW = 0.02  # seconds
+    
+    # Files longer than this are analyzed in chunks (see _split_code_for_analysis)
+    MAX_CHUNK_CHARS = 8000
+    
+    # Threads for blocking predict() RPCs, so many batches can be in flight
+    MAX_PREDICT_WORKERS = 32
+    
+    # Results cached per (file path, code) so unchanged files skip the endpoint
+    CACHE_MAX_ENTRIES = 1024
+    CACHE_TTL = 3600  # seconds
+    
+    def __init__(self, project_id: Optional[str] = None, region: Optional[str] = None) -> None:
         # Configuration from environment or parameters
         self.project_id = project_id or os.getenv("GOOGLE_CLOUD_PROJECT", "code-analyzer-service-account")
         self.region = region or os.getenv("VERTEX_AI_REGION", "us-central1")
         
-        # Initialize Vertex AI
-        aiplatform.init(project=self.project_id, location=self.region)
+        # Initialize Vertex AI; imported here since loading the SDK is slow and
+        # importing this module should not pay for it
+        from google.cloud import aiplatform
+        try:
+            # Imported as part of the python package (python.vertex_ai_endpoint_manager)
+            from .vertex_ai_setup import init_aiplatform
+        except ImportError:
+            # Run as a script or with python/ on sys.path
+            from vertex_ai_setup import init_aiplatform
+        self._aiplatform = aiplatform
+        init_aiplatform(self.project_id, self.region)
+        
+        # Predictions go through one GAPIC client on a long-lived channel,
+        # rather than the Endpoint wrapper's own client
+        from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceClient
+        from google.cloud.aiplatform_v1.services.prediction_service.transports import PredictionServiceGrpcTransport
+        api_endpoint = f"{self.region}-aiplatform.googleapis.com"
+        self._prediction_client = PredictionServiceClient(
+            transport=PredictionServiceGrpcTransport(
+                host=api_endpoint,
+                channel=PredictionServiceGrpcTransport.create_channel(
+                    f"{api_endpoint}:443", options=PREDICT_CHANNEL_OPTIONS
+                )
+            )
+        )
+        
+        # Prediction parameters are the same for every batch, so they are
+        # converted to their protobuf form once instead of on every predict()
+        from google.protobuf import json_format, struct_pb2
+        self._parameters = json_format.ParseDict(
+            {
+                "maxOutputTokens": 2048,  # Increased for comprehensive analysis
+                "temperature": 0.2,       # Lower temperature for consistent results
+                "topP": 0.8,
+                "topK": 40
+            },
+            struct_pb2.Value()
+        )
         
         # Endpoint configuration
         self.endpoint_display_name = "code-analyzer-endpoint"
         self.endpoint = None
         self.endpoint_id = None
         
+        # Continuous batching of analyze_code_with_endpoint calls: a consumer
+        # task collects queued requests for up to BATCH_WINDOW seconds, or
+        # until MAX_BATCH_SIZE requests / MAX_BATCH_TOKENS estimated prompt
+        # tokens, and sends them as one prediction. Started on first use,
+        # since it needs a running event loop.
+        self._queue: Optional[asyncio.Queue] = None
+        self._consumer_task: Optional[asyncio.Task] = None
+        self._batch_tasks = set()
+        
+        # Dedicated pool for predict(); the loop's default executor is shared
+        # and sized from the CPU count, which is too small for I/O-bound RPCs
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.MAX_PREDICT_WORKERS, thread_name_prefix="vertex-predict"
+        )
+        
+        # Analysis cache: key -> (stored_at, result), least recently used first
+        self._cache: "OrderedDict[Tuple[str, str], Tuple[float, AnalysisResult]]" = OrderedDict()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        
         logger.info(f"✅ VertexAI Endpoint Manager initialized for project: {self.project_id}")
     
     async def create_endpoint(self) -> str:
@@ -42,7 +295,7 @@ class VertexAIEndpointManager:
             logger.info(f"🚀 Creating Vertex AI Endpoint '{self.endpoint_display_name}'...")
             
             # Create the endpoint asynchronously
-            self.endpoint = aiplatform.Endpoint.create(
+            self.endpoint = self._aiplatform.Endpoint.create(
                 display_name=self.endpoint_display_name,
                 project=self.project_id,
                 location=self.region,
@@ -51,9 +304,9 @@ class VertexAIEndpointManager:
             logger.info("✅ Endpoint creation initiated.")
             logger.info(f"📍 Full Endpoint Resource Name: {self.endpoint.resource_name}")
             
-            # Extract endpoint ID from the full resource name
+            # Extract endpoint ID (the last path segment) from the full resource name
             # Format: projects/{project}/locations/{location}/endpoints/{endpoint_id}
-            self.endpoint_id = self.endpoint.name.split("/")[-1]
+            self.endpoint_id = self.endpoint.name.rpartition("/")[2]
             
             logger.info(f"🆔 Endpoint ID: {self.endpoint_id}")
             
@@ -63,7 +316,7 @@ class VertexAIEndpointManager:
             logger.error(f"❌ Failed to create endpoint: {str(e)}")
             raise
     
-    def get_existing_endpoint(self, endpoint_id: str) -> aiplatform.Endpoint:
+    def get_existing_endpoint(self, endpoint_id: str) -> "aiplatform.Endpoint":
         """
         Get an existing endpoint by ID.
         
@@ -75,11 +328,14 @@ class VertexAIEndpointManager:
         """
         try:
             self.endpoint_id = endpoint_id
-            self.endpoint = aiplatform.Endpoint(
-                endpoint_id=endpoint_id,
-                project=self.project_id,
-                location=self.region
-            )
+            key = (self.project_id, self.region, endpoint_id)
+            self.endpoint = _ENDPOINTS.get(key)
+            if self.endpoint is None:
+                self.endpoint = _ENDPOINTS[key] = self._aiplatform.Endpoint(
+                    endpoint_id=endpoint_id,
+                    project=self.project_id,
+                    location=self.region
+                )
             
             logger.info(f"✅ Connected to existing endpoint: {endpoint_id}")
             return self.endpoint
@@ -88,10 +344,15 @@ class VertexAIEndpointManager:
             logger.error(f"❌ Failed to connect to endpoint {endpoint_id}: {str(e)}")
             raise
     
-    async def analyze_code_with_endpoint(self, code_content: str, file_path: str) -> Dict[str, Any]:
+    async def analyze_code_with_endpoint(self, code_content: str, file_path: str) -> AnalysisResult:
         """
         Analyze code using the Vertex AI endpoint.
         
+        The request is queued and sent together with other concurrent
+        requests in one batched prediction (see _batch_loop). Files longer
+        than MAX_CHUNK_CHARS are split into chunks that are analyzed as one
+        batch and merged into a single result.
+        
         Args:
             code_content: The source code to analyze
             file_path: Path to the file being analyzed
@@ -102,86 +363,292 @@ class VertexAIEndpointManager:
         if not self.endpoint:
             raise ValueError("No endpoint available. Create or connect to an endpoint first.")
         
-        try:
-            # Create analysis prompt
-            prompt = self._create_analysis_prompt(code_content, file_path)
+        if len(code_content) > self.MAX_CHUNK_CHARS:
+            chunks = _split_code_for_analysis(code_content, self.MAX_CHUNK_CHARS)
+            if len(chunks) > 1:
+                results = await self.analyze_codes_batch([(chunk, file_path) for chunk, _ in chunks])
+                return self._merge_chunk_results(file_path, results, [offset for _, offset in chunks])
+        
+        cached = self._cache_get(self._cache_key(code_content, file_path))
+        if cached is not None:
+            return cached
+        
+        future = asyncio.get_running_loop().create_future()
+        self._ensure_batcher().put_nowait((code_content, file_path, future))
+        return await future
+    
+    def _ensure_batcher(self) -> asyncio.Queue:
+        """Return the request queue, starting its consumer on the running loop if needed."""
+        loop = asyncio.get_running_loop()
+        if self._consumer_task is None or self._consumer_task.done() or self._consumer_task.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._consumer_task = loop.create_task(self._batch_loop(self._queue))
+        return self._queue
+    
+    async def _batch_loop(self, queue: asyncio.Queue) -> None:
+        """
+        Collect queued requests into batches and dispatch each as one prediction.
+        
+        Waits for a first request, then keeps taking requests until the batch
+        window closes or the batch is full. Batches are predicted in their own
+        tasks so the next batch is collected while earlier ones are in flight.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            tokens = len(batch[0][0]) // 4
+            deadline = loop.time() + self.BATCH_WINDOW
             
-            logger.info(f"🔍 Analyzing code with Vertex AI endpoint...")
+            while len(batch) < self.MAX_BATCH_SIZE and tokens < self.MAX_BATCH_TOKENS:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                tokens += len(item[0]) // 4
             
-            # Define the instance payload for prediction
-            instance = [{"content": prompt}]
-            parameters = {
-                "maxOutputTokens": 2048,  # Increased for comprehensive analysis
-                "temperature": 0.2,       # Lower temperature for consistent results
-                "topP": 0.8,
-                "topK": 40
-            }
+            task = loop.create_task(self._dispatch_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _dispatch_batch(self, batch: List[Tuple[str, str, asyncio.Future]]) -> None:
+        """Predict a collected batch and hand each result to its waiting caller."""
+        results = await self._analyze_batch([(code_content, file_path) for code_content, file_path, _ in batch])
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    async def analyze_many(
+        self, files: List[Tuple[str, str]], concurrency: int = 20
+    ) -> List[AnalysisResult]:
+        """
+        Analyze many files concurrently through analyze_code_with_endpoint.
+        
+        At most `concurrency` files are in flight at once; beyond about 20
+        concurrent requests the endpoint mostly queues them, adding latency
+        without throughput.
+        
+        Args:
+            files: (code_content, file_path) pairs
+            concurrency: Maximum number of files analyzed at the same time
             
-            # Make prediction
-            prediction = self.endpoint.predict(instances=instance, parameters=parameters)
+        Returns:
+            Analysis results in the same order as files
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def analyze_one(code_content: str, file_path: str) -> AnalysisResult:
+            async with semaphore:
+                return await self.analyze_code_with_endpoint(code_content, file_path)
+        
+        return await asyncio.gather(*(analyze_one(code_content, file_path) for code_content, file_path in files))
+    
+    async def stream_issues(self, items: List[Tuple[str, str]]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Analyze several files and yield their issues as each file completes.
+        
+        Files go through analyze_code_with_endpoint, so they are batched
+        together; issues are yielded per file as soon as its batch is done
+        instead of after the whole set, and no combined result is built.
+        
+        Args:
+            items: (code_content, file_path) pairs
             
-            # Parse the model's response
-            response_text = prediction.predictions[0]['content']
-            clean_response = response_text.strip().replace("```json", "").replace("```", "").strip()
+        Yields:
+            Issue dictionaries, each with the "file_path" it belongs to
+        """
+        tasks = [
+            asyncio.ensure_future(self.analyze_code_with_endpoint(code_content, file_path))
+            for code_content, file_path in items
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                if "error" in result:
+                    logger.warning(f"⚠️ No issues for {result.get('file_path')}: {result['error']}")
+                    continue
+                for issue in result.get("issues", []):
+                    issue.setdefault("file_path", result.get("file_path"))
+                    yield issue
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def analyze_codes_batch(
+        self, items: List[Tuple[str, str]], batch_size: int = 16
+    ) -> List[AnalysisResult]:
+        """
+        Analyze many files, sending up to batch_size prompts per prediction.
+        
+        Each predict() call carries a batch of instances, so the network
+        round trip and per-request overhead are paid once per batch rather
+        than once per file. Batches are predicted concurrently.
+        
+        Args:
+            items: (code_content, file_path) pairs
+            batch_size: Maximum number of files per prediction request
             
-            try:
-                analysis_result = json.loads(clean_response)
-            except json.JSONDecodeError:
-                # Fallback: create structured response from text
-                analysis_result = self._parse_text_response(response_text, file_path)
+        Returns:
+            Analysis results in the same order as items; a failed batch yields
+            {"error": ..., "file_path": ...} for each of its files
+        """
+        if not self.endpoint:
+            raise ValueError("No endpoint available. Create or connect to an endpoint first.")
+        
+        # Cached files are answered directly; only the rest are predicted
+        results: List[Optional[AnalysisResult]] = [
+            self._cache_get(self._cache_key(code_content, file_path)) for code_content, file_path in items
+        ]
+        pending = [i for i, result in enumerate(results) if result is None]
+        
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        batch_results = await asyncio.gather(
+            *(self._analyze_batch([items[i] for i in batch]) for batch in batches)
+        )
+        for batch, analyzed in zip(batches, batch_results):
+            for i, result in zip(batch, analyzed):
+                results[i] = result
+        return results
+    
+    @staticmethod
+    def _merge_chunk_results(
+        file_path: str, results: List[AnalysisResult], line_offsets: List[int]
+    ) -> AnalysisResult:
+        """
+        Combine the analyses of one file's chunks into a single result.
+        
+        Issue lines are shifted back to positions in the whole file; the
+        quality score and metrics are averaged over the chunks.
+        
+        Args:
+            file_path: Path to the analyzed file
+            results: Analysis result per chunk
+            line_offsets: Lines preceding each chunk in the file
+            
+        Returns:
+            Merged analysis result, with "chunk_errors" listing chunks that failed
+        """
+        issues = []
+        scores = []
+        metrics: Dict[str, List[float]] = {}
+        insights: Dict[str, None] = {}
+        errors = []
+        for result, offset in zip(results, line_offsets):
+            if "error" in result:
+                errors.append(result["error"])
+                continue
+            for issue in result.get("issues", []):
+                if isinstance(issue.get("line"), int):
+                    issue["line"] += offset
+                issues.append(issue)
+            if isinstance(result.get("quality_score"), (int, float)):
+                scores.append(result["quality_score"])
+            for name, value in result.get("metrics", {}).items():
+                if isinstance(value, (int, float)):
+                    metrics.setdefault(name, []).append(value)
+            insights.update(dict.fromkeys(result.get("ai_insights", [])))
+        
+        if len(errors) == len(results):
+            return {"error": errors[0], "file_path": file_path}
+        
+        merged: AnalysisResult = {
+            "file_path": file_path,
+            "quality_score": _mean(scores),
+            "issues": issues,
+            "metrics": {name: _mean(values) for name, values in metrics.items()},
+            "ai_insights": list(insights)
+        }
+        if errors:
+            merged["chunk_errors"] = errors
+        return merged
+    
+    @staticmethod
+    def _cache_key(code_content: str, file_path: str) -> Tuple[str, str]:
+        """Cache key: the file path and a digest of its code."""
+        return file_path, hashlib.blake2b(code_content.encode('utf-8'), digest_size=16).hexdigest()
+    
+    def _cache_get(self, key: Tuple[str, str]) -> Optional[AnalysisResult]:
+        """Return a copy of a cached, unexpired result, or None."""
+        entry = self._cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.CACHE_TTL:
+            self._cache.move_to_end(key)
+            self._cache_hits += 1
+            return copy.deepcopy(entry[1])
+        if entry is not None:
+            del self._cache[key]
+        self._cache_misses += 1
+        return None
+    
+    def _cache_put(self, key: Tuple[str, str], result: AnalysisResult) -> None:
+        """Store a copy of a result, evicting the least recently used entries."""
+        self._cache[key] = (time.monotonic(), copy.deepcopy(result))
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.CACHE_MAX_ENTRIES:
+            self._cache.popitem(last=False)
+    
+    async def _analyze_batch(self, batch: List[Tuple[str, str]]) -> List[AnalysisResult]:
+        """Run one batched prediction and parse a result per file."""
+        try:
+            # Define the instance payload for prediction
+            instances = [
+                {"content": self._create_analysis_prompt(code_content, file_path)}
+                for code_content, file_path in batch
+            ]
             
-            logger.info(f"✅ Analysis completed for {file_path}")
-            return analysis_result
+            logger.info(f"🔍 Analyzing {len(batch)} files with Vertex AI endpoint...")
             
+            # predict() blocks on the RPC, so run it off the event loop
+            loop = asyncio.get_running_loop()
+            prediction = await loop.run_in_executor(
+                self._executor,
+                partial(
+                    self._prediction_client.predict,
+                    endpoint=self.endpoint.resource_name, instances=instances, parameters=self._parameters
+                )
+            )
+            if len(prediction.predictions) != len(batch):
+                raise ValueError(f"Expected {len(batch)} predictions, got {len(prediction.predictions)}")
         except Exception as e:
-            logger.error(f"❌ Analysis failed for {file_path}: {str(e)}")
-            return {"error": str(e), "file_path": file_path}
+            logger.error(f"❌ Analysis failed for {len(batch)} files: {str(e)}")
+            return [{"error": str(e), "file_path": file_path} for _, file_path in batch]
+        
+        results = []
+        for output, (code_content, file_path) in zip(prediction.predictions, batch):
+            try:
+                result = self._parse_prediction(output['content'], file_path)
+                self._cache_put(self._cache_key(code_content, file_path), result)
+                results.append(result)
+            except Exception as e:
+                logger.error(f"❌ Analysis failed for {file_path}: {str(e)}")
+                results.append({"error": str(e), "file_path": file_path})
+        return results
     
-    def _create_analysis_prompt(self, code_content: str, file_path: str) -> str:
-        """Create a structured prompt for code analysis."""
-        return f"""
-        Please analyze the following code for security, quality, and performance issues.
-        Return your findings as a valid JSON object with this structure:
-        {{
-            "file_path": "{file_path}",
-            "quality_score": <number 0-100>,
-            "issues": [
-                {{
-                    "type": "<security|quality|performance>",
-                    "severity": "<critical|high|medium|low>",
-                    "line": <line_number>,
-                    "message": "<description>",
-                    "rule": "<rule_id>",
-                    "suggestion": "<fix_suggestion>",
-                    "confidence": <0.0-1.0>
-                }}
-            ],
-            "metrics": {{
-                "complexity": <number>,
-                "maintainability": <number>,
-                "test_coverage": <number>
-            }},
-            "ai_insights": [
-                "<insight_1>",
-                "<insight_2>"
-            ]
-        }}
-
-        Code to analyze:
-        File: {file_path}
+    def _parse_prediction(self, response_text: str, file_path: str) -> AnalysisResult:
+        """Parse the model's response for one file."""
+        clean_response = _strip_code_fence(response_text)
+        
+        try:
+            analysis_result = _json_loads(clean_response)
+        except json.JSONDecodeError:
+            # Fallback: create structured response from text
+            analysis_result = self._parse_text_response(response_text, file_path)
         
-        ```
-        {code_content}
-        ```
+        # The prompt's schema carries a placeholder path, not the real one
+        if isinstance(analysis_result, dict):
+            analysis_result["file_path"] = file_path
         
-        Focus on:
-        1. Security vulnerabilities (SQL injection, XSS, etc.)
-        2. Code quality issues (complexity, maintainability)
-        3. Performance bottlenecks
-        4. Best practice violations
-        """
+        logger.info(f"✅ Analysis completed for {file_path}")
+        return analysis_result
     
-    def _parse_text_response(self, response_text: str, file_path: str) -> Dict[str, Any]:
+    def _create_analysis_prompt(self, code_content: str, file_path: str) -> str:
+        """Create a structured prompt for code analysis, with focus points for the file's language."""
+        prefix = _PROMPT_PREFIXES.get(os.path.splitext(file_path)[1].lower(), _DEFAULT_PROMPT_PREFIX)
+        return f"{prefix}{file_path}\n\n```\n{code_content}\n```\n"
+    
+    def _parse_text_response(self, response_text: str, file_path: str) -> AnalysisResult:
         """Fallback parser for non-JSON responses."""
         return {
             "file_path": file_path,
@@ -210,7 +677,7 @@ class VertexAIEndpointManager:
         }
 
 # Example usage and testing
-async def main():
+async def main() -> None:
     """Test the Vertex AI Endpoint Manager."""
     print("🚀 Initializing Vertex AI Endpoint Manager...")
     
@@ -247,6 +714,10 @@ def complex_function(data):
     print("\n📝 Testing code analysis...")
     # result = await manager.analyze_code_with_endpoint(sample_code, "auth/login.py")
     # print(json.dumps(result, indent=2))
+    
+    print("\n📁 Testing multi-file analysis...")
+    # results = await manager.analyze_many([(sample_code, f"auth/login_{i}.py") for i in range(50)])
+    # print(f"Analyzed {len(results)} files")
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,6 +1,26 @@
 from google.cloud import aiplatform
 import os
-from typing import Optional
+import threading
+from typing import Optional, Tuple
+
+# (project, location) aiplatform was last initialized with. aiplatform.init
+# configures process-wide state, so only the current settings are tracked.
+_initialized_for: Optional[Tuple[str, str]] = None
+_init_lock = threading.Lock()
+
+
+def init_aiplatform(project_id: str, region: str) -> None:
+    """
+    Initialize the Vertex AI SDK unless it is already set up for this project and region.
+    
+    Shared by every manager so creating several of them does not rebuild
+    the SDK's clients each time.
+    """
+    global _initialized_for
+    with _init_lock:
+        if _initialized_for != (project_id, region):
+            aiplatform.init(project=project_id, location=region)
+            _initialized_for = (project_id, region)
 
 class VertexAIManager:
     """
@@ -31,7 +51,7 @@ class VertexAIManager:
                 print("   Please set it to your service account key file path")
             
             # Initialize Vertex AI
-            aiplatform.init(project=self.project_id, location=self.region)
+            init_aiplatform(self.project_id, self.region)
             
             print(f"✅ Vertex AI SDK initialized successfully!")
             print(f"   Project: {self.project_id}")